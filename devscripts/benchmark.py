@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks ManualBoxFS directly, without mounting it and without Qt dialogs.
+
+Every access is approved by a stub callback, and fuse_get_context is replaced
+so that the calls look like they come from this process. The results are
+printed as JSON, so they can be saved and compared between versions.
+"""
+
+import argparse
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.fernet import Fernet
+
+import manualbox
+import manualbox.fs
+
+
+def approve(display_path, process_name):
+    return "okay"
+
+
+def fake_context():
+    return os.getuid(), os.getgid(), os.getpid()
+
+
+def peak_rss():
+    "Peak resident memory of this process in bytes"
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage if sys.platform == "darwin" else usage * 1024
+
+
+class Timer:
+    "Collects the latency of every call of one operation"
+
+    def __init__(self):
+        self.latencies = []
+        self.bytes = 0
+
+    def call(self, func, *args, size=0):
+        start = time.perf_counter()
+        result = func(*args)
+        self.latencies.append(time.perf_counter() - start)
+        self.bytes += size
+        return result
+
+    def percentile(self, latencies, percent):
+        index = min(len(latencies) - 1, int(len(latencies) * percent / 100))
+        return latencies[index] * 1e6
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        total = sum(latencies)
+        result = {
+            "ops": len(latencies),
+            "seconds": round(total, 6),
+            "ops_per_sec": round(len(latencies) / total, 1) if total else None,
+            "p50_us": round(self.percentile(latencies, 50), 1),
+            "p90_us": round(self.percentile(latencies, 90), 1),
+            "p99_us": round(self.percentile(latencies, 99), 1),
+            "max_us": round(latencies[-1] * 1e6, 1),
+        }
+        if self.bytes:
+            result["mb_per_sec"] = round(self.bytes / total / 2**20, 1)
+        return result
+
+
+def newfs(key, storagepath, workers=None):
+    return manualbox.ManualBoxFS(
+        key=key,
+        mountpath="/benchmark",
+        storagepath=storagepath,
+        callback=approve,
+        workers=workers,
+    )
+
+
+def run(args):
+    manualbox.fs.fuse_get_context = fake_context
+    rnd = random.Random(args.seed)
+    workdir = tempfile.mkdtemp(prefix="manualbox-benchmark-")
+    storagepath = os.path.join(workdir, "storage")
+    key = Fernet.generate_key()
+    results = {}
+    try:
+        fs = newfs(key, storagepath, args.workers)
+        dirs = [f"/dir{number}" for number in range(args.dirs)]
+        for path in dirs:
+            fs("mkdir", path, 0o755)
+        paths = [
+            f"{dirs[number % args.dirs]}/file{number}" for number in range(args.files)
+        ]
+        request = args.request_size
+        payload = os.urandom(request)
+        offsets = range(0, args.size, request)
+
+        timer = Timer()
+        handles = [timer.call(fs, "create", path, 0o644) for path in paths]
+        results["create"] = timer.report()
+
+        timer = Timer()
+        for path, fh in zip(paths, handles):
+            for offset in offsets:
+                timer.call(fs, "write", path, payload, offset, fh, size=len(payload))
+        results["sequential_write"] = timer.report()
+
+        timer = Timer()
+        for path, fh in zip(paths, handles):
+            for _ in offsets:
+                offset = rnd.randrange(0, args.size, request)
+                timer.call(fs, "write", path, payload, offset, fh, size=len(payload))
+        results["random_write"] = timer.report()
+
+        timer = Timer()
+        for path, fh in zip(paths, handles):
+            for offset in offsets:
+                timer.call(fs, "read", path, request, offset, fh, size=request)
+        results["sequential_read"] = timer.report()
+
+        timer = Timer()
+        for path, fh in zip(paths, handles):
+            for _ in offsets:
+                offset = rnd.randrange(0, args.size, request)
+                timer.call(fs, "read", path, request, offset, fh, size=request)
+        results["random_read"] = timer.report()
+
+        timer = Timer()
+        for path in ["/"] + dirs:
+            timer.call(fs, "readdir", path, 0)
+        results["readdir"] = timer.report()
+
+        timer = Timer()
+        for number, path in enumerate(paths):
+            newpath = f"{path}.renamed"
+            timer.call(fs, "rename", path, newpath)
+            paths[number] = newpath
+        results["rename"] = timer.report()
+
+        total = args.files * len(offsets) * request
+        timer = Timer()
+        timer.call(fs.saveondisk, size=total)
+        results["save"] = timer.report()
+
+        # A small change after a full save, which goes into the journal
+        fs("write", paths[0], payload, 0, handles[0])
+        timer = Timer()
+        timer.call(fs.saveondisk, size=len(payload))
+        results["incremental_save"] = timer.report()
+        for path, fh in zip(paths, handles):
+            fs("release", path, fh)
+        fs.close()
+
+        timer = Timer()
+        fs = timer.call(newfs, key, storagepath, args.workers)
+        results["load"] = timer.report()
+
+        # Reading everything once after the load decrypts every block
+        timer = Timer()
+        for path in paths:
+            fh = fs("open", path, os.O_RDONLY)
+            for offset in offsets:
+                timer.call(fs, "read", path, request, offset, fh, size=request)
+            fs("release", path, fh)
+        results["cold_read"] = timer.report()
+        fs.close()
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        "config": vars(args),
+        "results": results,
+        "peak_rss_bytes": peak_rss(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=100, help="number of files")
+    parser.add_argument("--dirs", type=int, default=10, help="number of directories")
+    parser.add_argument(
+        "--size", type=int, default=1024 * 1024, help="size of every file in bytes"
+    )
+    parser.add_argument(
+        "--request-size",
+        type=int,
+        default=128 * 1024,
+        help="size of every read and write in bytes",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="threads which encrypt and decrypt the blocks (default: one per CPU)",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as fobj:
+            fobj.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks a real ManualBox mount under every mount profile.
+
+The filesystem runs in a child process on a new storage, and this process
+answers every question over the approval socket. For every profile a
+metadata heavy run (stat and listdir), a streaming run (large writes and
+reads) and a check that an expired answer asks the user again are measured.
+The upcalls come from /.manualbox/stats in the mount. Needs libfuse.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cryptography.fernet import Fernet
+
+from manualbox.broker import OKAY, ApprovalBroker, Client, SocketServer
+from manualbox.fs import ManualBoxFS
+from manualbox.profiles import PROFILES, mount
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def serve(storagepath, mountpath, socketpath, profile, ttl):
+    "Runs in the child process till the filesystem gets unmounted"
+    broker = ApprovalBroker()
+    fs = ManualBoxFS(
+        key=Fernet.generate_key(),
+        mountpath=mountpath,
+        storagepath=storagepath,
+        callback=broker.ask,
+        access_ttl=ttl,
+    )
+    fs.stats.sources["approvals"] = broker.stats
+    server = SocketServer(broker, socketpath)
+    server.start()
+    try:
+        mount(fs, mountpath, profile=profile)
+    finally:
+        server.stop()
+
+
+class Approver:
+    "Answers every question with OKAY and counts them"
+
+    def __init__(self, socketpath):
+        self.client = Client(socketpath)
+        self.asked = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for message in self.client:
+            if "path" in message:
+                self.asked += 1
+                self.client.answer(message["id"], OKAY)
+
+    def close(self):
+        self.client.close()
+
+
+def unmount(mountpath):
+    if sys.platform == "darwin":
+        subprocess.run(["umount", mountpath], check=False)
+    else:
+        subprocess.run(["fusermount", "-u", mountpath], check=False)
+
+
+def upcalls(mountpath):
+    "Calls of every operation so far"
+    with open(os.path.join(mountpath, ".manualbox", "stats")) as fobj:
+        operations = json.load(fobj)["operations"]
+    return {op: values["calls"] for op, values in operations.items()}
+
+
+def difference(before, after):
+    return {
+        op: calls - before.get(op, 0)
+        for op, calls in sorted(after.items())
+        if calls != before.get(op, 0)
+    }
+
+
+def readall(path):
+    size = 0
+    with open(path, "rb", buffering=0) as fobj:
+        while True:
+            data = fobj.read(CHUNK_SIZE)
+            if not data:
+                return size
+            size += len(data)
+
+
+def metadata(mountpath, args):
+    "Many stat and listdir calls on a tree of small files"
+    dirs = [os.path.join(mountpath, f"dir{number}") for number in range(args.dirs)]
+    paths = []
+    for number, path in enumerate(dirs):
+        os.mkdir(path)
+        for index in range(args.files // args.dirs):
+            paths.append(os.path.join(path, f"file{index}"))
+            with open(paths[-1], "wb") as fobj:
+                fobj.write(b"x" * 100)
+    before = upcalls(mountpath)
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+        for path in dirs:
+            os.listdir(path)
+        for path in paths:
+            os.stat(path)
+    seconds = time.perf_counter() - start
+    calls = difference(before, upcalls(mountpath))
+    operations = args.rounds * (len(dirs) + len(paths))
+    return {
+        "operations": operations,
+        "ops_per_sec": round(operations / seconds, 1),
+        "upcalls": calls,
+        "upcalls_per_op": round(sum(calls.values()) / operations, 3),
+    }
+
+
+def streaming(mountpath, args, approver):
+    "Writes one large file and reads it back twice"
+    path = os.path.join(mountpath, "large")
+    chunk = os.urandom(CHUNK_SIZE)
+    before = upcalls(mountpath)
+    start = time.perf_counter()
+    with open(path, "wb") as fobj:
+        for _ in range(args.size):
+            fobj.write(chunk)
+    written = time.perf_counter() - start
+    calls = difference(before, upcalls(mountpath))
+    result = {
+        "write_mb_per_sec": round(args.size / written, 1),
+        "write_upcalls": calls.get("write", 0),
+    }
+    for name in ("first_read", "second_read"):
+        before = upcalls(mountpath)
+        start = time.perf_counter()
+        readall(path)
+        seconds = time.perf_counter() - start
+        calls = difference(before, upcalls(mountpath))
+        result[f"{name}_mb_per_sec"] = round(args.size / seconds, 1)
+        result[f"{name}_upcalls"] = calls.get("read", 0)
+    result["asked"] = approver.asked
+    return result
+
+
+def reask(mountpath, args, approver):
+    "An answer which expired must ask again, whatever the kernel cached"
+    path = os.path.join(mountpath, "small")
+    with open(path, "wb") as fobj:
+        fobj.write(b"y" * 4096)
+    readall(path)
+    asked = approver.asked
+    readall(path)
+    within = approver.asked - asked
+    time.sleep(args.ttl + 2)
+    readall(path)
+    return {"asked_within_ttl": within, "asked_after_ttl": approver.asked - asked}
+
+
+def run(profile, args):
+    workdir = tempfile.mkdtemp(prefix="manualbox-mountbench-")
+    mountpath = os.path.join(workdir, "mount")
+    socketpath = os.path.join(workdir, "approve.sock")
+    os.mkdir(mountpath)
+    child = multiprocessing.Process(
+        target=serve,
+        args=(
+            os.path.join(workdir, "storage"),
+            mountpath,
+            socketpath,
+            profile,
+            args.ttl,
+        ),
+    )
+    child.start()
+    try:
+        deadline = time.monotonic() + 10
+        while not (os.path.ismount(mountpath) and os.path.exists(socketpath)):
+            if time.monotonic() > deadline or not child.is_alive():
+                raise RuntimeError(f"Mounting with the {profile} profile failed")
+            time.sleep(0.05)
+        approver = Approver(socketpath)
+        try:
+            return {
+                "metadata": metadata(mountpath, args),
+                "streaming": streaming(mountpath, args, approver),
+                "reask": reask(mountpath, args, approver),
+            }
+        finally:
+            approver.close()
+    finally:
+        unmount(mountpath)
+        child.join(10)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--profile",
+        action="append",
+        choices=sorted(PROFILES),
+        help="profile to measure, can be given more than once (default: all)",
+    )
+    parser.add_argument("--files", type=int, default=1000, help="number of files")
+    parser.add_argument("--dirs", type=int, default=10, help="number of directories")
+    parser.add_argument("--rounds", type=int, default=5, help="stat rounds")
+    parser.add_argument(
+        "--size", type=int, default=64, help="size of the large file in MiB"
+    )
+    parser.add_argument(
+        "--ttl", type=float, default=2, help="seconds an answer is valid"
+    )
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    results = {
+        profile: run(profile, args) for profile in args.profile or sorted(PROFILES)
+    }
+    report = json.dumps({"config": vars(args), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as fobj:
+            fobj.write(report + "\n")
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+from collections import OrderedDict
+
+# How many bytes of decrypted blocks are kept by default
+CACHE_SIZE = 128 * 1024 * 1024
+
+
+class BlockCache:
+    """
+    Decrypted blocks by digest, at most maxbytes bytes of them.
+
+    The least recently used block is dropped first, the store can decrypt it
+    again from the disk. Only clean blocks are in here, the dirty ones stay
+    with their file till a save writes them out, see Checkpointer for how
+    much of them there can be. The caller does the locking.
+    """
+
+    def __init__(self, maxbytes=CACHE_SIZE):
+        self.maxbytes = maxbytes
+        self.blocks = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, digest):
+        return digest in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def get(self, digest):
+        "Returns the block of the digest, or None"
+        block = self.blocks.get(digest)
+        if block is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.blocks.move_to_end(digest)
+        return block
+
+    def put(self, digest, block):
+        "Adds the block unless it is there already, and returns the cached one"
+        cached = self.blocks.get(digest)
+        if cached is not None:
+            return cached
+        self.blocks[digest] = block
+        self.size += len(block)
+        # The new block stays, even if it does not fit alone
+        while self.size > self.maxbytes and len(self.blocks) > 1:
+            _, old = self.blocks.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+        return block
+
+    def pop(self, digest):
+        block = self.blocks.pop(digest, None)
+        if block is not None:
+            self.size -= len(block)
+
+    def clear(self):
+        "Forgets every block"
+        self.blocks.clear()
+        self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "decrypted": len(self.blocks),
+            "decrypted_bytes": self.size,
+            "max_bytes": self.maxbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,309 @@
+import argparse
+import getpass
+import hmac
+import itertools
+import json
+import logging
+import os
+import queue
+import secrets
+import socket
+import socketserver
+import struct
+import sys
+import threading
+from pathlib import Path
+from time import perf_counter
+
+OKAY, NOPE = "okay", "nope"
+
+
+def default_socket_path():
+    "The socket is in the runtime directory of the user, or else in the home"
+    runtime = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return os.path.join(runtime, "manualbox.sock")
+    return os.path.join(str(Path.home()), ".manualbox.sock")
+
+
+def newtoken():
+    "A token for one session of the socket, short enough to type"
+    return secrets.token_hex(8)
+
+
+class Request:
+    "One question, the asking thread waits on event till answer is set"
+
+    __slots__ = ("id", "display_path", "process_name", "answer", "event")
+
+    def __init__(self, ident, display_path, process_name):
+        self.id = ident
+        self.display_path = display_path
+        self.process_name = process_name
+        self.answer = None
+        self.event = threading.Event()
+
+
+class ApprovalBroker:
+    """
+    Passes every question to the listeners, and returns the first answer
+    any of them gives.
+
+    ask is the callback for ManualBoxFS. The asking thread sleeps on an event
+    till the answer comes, or till timeout seconds passed, which denies the
+    access. A listener has asked(request) and answered(request) methods,
+    which are called from the thread asking or answering, so they must not
+    block.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.pending = {}
+        self.listeners = []
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.asked = 0
+        self.timedout = 0
+        self.waited = 0.0
+
+    def subscribe(self, listener):
+        "Adds the listener, and returns the questions which wait for an answer"
+        with self.lock:
+            self.listeners.append(listener)
+            return list(self.pending.values())
+
+    def unsubscribe(self, listener):
+        with self.lock:
+            if listener in self.listeners:
+                self.listeners.remove(listener)
+
+    def notify(self, method, request, listeners):
+        for listener in listeners:
+            try:
+                getattr(listener, method)(request)
+            except Exception:
+                logging.exception(f"Approval listener {listener} failed")
+
+    def ask(self, display_path, process_name):
+        "Returns OKAY or NOPE once somebody answered"
+        start = perf_counter()
+        with self.lock:
+            request = Request(next(self.ids), display_path, process_name)
+            self.pending[request.id] = request
+            self.asked += 1
+            listeners = list(self.listeners)
+        self.notify("asked", request, listeners)
+        if not request.event.wait(self.timeout):
+            if self.answer(request.id, NOPE):
+                with self.lock:
+                    self.timedout += 1
+        with self.lock:
+            self.waited += perf_counter() - start
+        return request.answer
+
+    def answer(self, ident, answer):
+        "Answers the question, returns False if it was already answered"
+        with self.lock:
+            request = self.pending.pop(ident, None)
+            if request is None:
+                return False
+            request.answer = OKAY if answer == OKAY else NOPE
+            listeners = list(self.listeners)
+        request.event.set()
+        self.notify("answered", request, listeners)
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {
+                "asked": self.asked,
+                "pending": len(self.pending),
+                "timed_out": self.timedout,
+                "listeners": len(self.listeners),
+                "seconds_waiting": round(self.waited, 6),
+            }
+
+
+class ClientHandler(socketserver.StreamRequestHandler):
+    """
+    One connected client. Messages to the client are queued and written by
+    their own thread, so a slow client never holds up the filesystem.
+    """
+
+    def setup(self):
+        super().setup()
+        self.outgoing = queue.Queue()
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def asked(self, request):
+        self.outgoing.put(
+            {
+                "id": request.id,
+                "path": request.display_path,
+                "process": request.process_name,
+            }
+        )
+
+    def answered(self, request):
+        self.outgoing.put({"id": request.id, "answer": request.answer})
+
+    def write(self):
+        while True:
+            message = self.outgoing.get()
+            if message is None:
+                return
+            try:
+                self.wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+                self.wfile.flush()
+            except OSError:
+                return
+
+    def handle(self):
+        if not self.server.trusted(self.request):
+            return
+        if self.server.token is not None and not self.server.authenticated(
+            self.rfile.readline(1024)
+        ):
+            logging.warning("A client of the approval socket had a wrong token")
+            return
+        broker = self.server.broker
+        for request in broker.subscribe(self):
+            self.asked(request)
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                    broker.answer(int(message["id"]), message["answer"])
+                except (ValueError, KeyError, TypeError):
+                    logging.warning(f"Bad message on the approval socket: {line!r}")
+        except OSError:
+            # The client went away
+            pass
+        finally:
+            broker.unsubscribe(self)
+            self.outgoing.put(None)
+            self.writer.join()
+
+
+class SocketServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Serves the questions of the broker on a UNIX socket only the user can
+    open. On Linux the user id of every client is checked as well.
+
+    Every message is one line of JSON. The server sends
+    {"id": 1, "path": "/home/user/secured/file", "process": "cat"} for every
+    question, and {"id": 1, "answer": "okay"} once anybody answered it. A
+    client answers with {"id": 1, "answer": "okay"} or "nope".
+
+    Any process of the user can open the socket, so with a token the first
+    line of a client has to be {"token": "..."}. A client without the right
+    one is disconnected before it sees any question. The token is only
+    shown to the user, who gives it to the client.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, broker, path=None, token=None):
+        self.broker = broker
+        self.path = path or default_socket_path()
+        self.token = token
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        umask = os.umask(0o177)
+        try:
+            super().__init__(self.path, ClientHandler)
+        finally:
+            os.umask(umask)
+        self.thread = None
+
+    def trusted(self, sock):
+        "Tells if the client runs as the same user, where we can find out"
+        if not hasattr(socket, "SO_PEERCRED"):
+            return True
+        credentials = sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")
+        )
+        pid, uid, gid = struct.unpack("3i", credentials)
+        return uid == os.getuid()
+
+    def authenticated(self, line):
+        "Tells if the first line of a client has the token"
+        try:
+            token = json.loads(line)["token"]
+        except (ValueError, KeyError, TypeError):
+            return False
+        return isinstance(token, str) and hmac.compare_digest(token, self.token)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Client:
+    "Connects to the approval socket, iterating gives the messages as dictionaries"
+
+    def __init__(self, path=None, token=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path or default_socket_path())
+        self.rfile = self.sock.makefile("rb")
+        if token:
+            self.send({"token": token})
+
+    def __iter__(self):
+        for line in self.rfile:
+            yield json.loads(line)
+
+    def send(self, message):
+        self.sock.sendall(json.dumps(message).encode("utf-8") + b"\n")
+
+    def answer(self, ident, answer):
+        self.send({"id": ident, "answer": answer})
+
+    def close(self):
+        # This also wakes up a thread which waits for the next message
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.rfile.close()
+        self.sock.close()
+
+
+def main():
+    "Answers the questions of a mounted ManualBox from the terminal"
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--socket", help="path of the approval socket")
+    parser.add_argument(
+        "--token-file", help="read the token from this file instead of asking for it"
+    )
+    args = parser.parse_args()
+    if args.token_file:
+        with open(args.token_file) as fobj:
+            token = fobj.read().strip()
+    else:
+        token = getpass.getpass("Token shown by ManualBox: ").strip()
+    client = Client(args.socket, token)
+    try:
+        for message in client:
+            if "answer" in message:
+                continue
+            reply = input(
+                f"Allow {message['process']} to read {message['path']}? [y/N] "
+            )
+            client.answer(message["id"], OKAY if reply.lower() == "y" else NOPE)
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,57 @@
+import logging
+import threading
+from time import monotonic
+
+
+class Checkpointer:
+    """
+    Saves the filesystem in the background while it is mounted.
+
+    A save happens every interval seconds when there are changes, or as soon
+    as dirty_bytes bytes were written since the last one. Saving works on a
+    snapshot, so the FUSE operations are only held up while it gets taken.
+    """
+
+    def __init__(self, fs, interval=60, dirty_bytes=64 * 1024 * 1024):
+        self.fs = fs
+        self.interval = interval
+        self.dirty_bytes = dirty_bytes
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = None
+        self.lastsave = monotonic()
+
+    def start(self):
+        if self.thread is None:
+            self.stopped = False
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        "Stops the thread, an ongoing save is finished first"
+        self.stopped = True
+        self.wakeup.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def written(self, dirty_bytes):
+        "Called by the filesystem after writes, with the bytes written since the last save"
+        if dirty_bytes >= self.dirty_bytes:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.stopped:
+            timeout = self.interval - (monotonic() - self.lastsave)
+            self.wakeup.wait(max(timeout, 0))
+            self.wakeup.clear()
+            if self.stopped:
+                break
+            due = monotonic() - self.lastsave >= self.interval
+            if not due and self.fs.dirtybytes < self.dirty_bytes:
+                continue
+            try:
+                self.fs.saveondisk()
+            except Exception:
+                logging.exception("Background save of the filesystem failed")
+            self.lastsave = monotonic()
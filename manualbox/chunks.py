@@ -0,0 +1,266 @@
+import threading
+
+BLOCK_SIZE = 64 * 1024
+# A hole reads back as a slice of this
+ZERO = bytes(BLOCK_SIZE)
+ZEROVIEW = memoryview(ZERO)
+
+
+def iszero(block):
+    "Tells if the block has only zero bytes"
+    return not block or (
+        block[0] == 0 and block[-1] == 0 and block == ZERO[: len(block)]
+    )
+
+
+class ChunkedFile:
+    """
+    Contents of a single file, kept as fixed-size blocks.
+
+    A write, read or truncate only touches the blocks it covers, so the cost of
+    an operation does not depend on the size of the whole file. Missing blocks
+    and the missing tail of a short block read back as zero bytes. A block
+    which gets written with only zero bytes is dropped, so a sparse file
+    costs nothing for its holes, in memory or on the disk.
+
+    The blocks dict holds the blocks written since the last save, their
+    indexes are also kept in dirty. stored holds the digests of the clean
+    blocks, which the store keeps once for all the files, see VaultStore.block.
+    Every digest in stored is a reference counted by the store.
+
+    A dirty block which was partly written is a bytearray, and later writes
+    change it in place. The blocks of a snapshot are shared with it, their
+    indexes are kept in frozen, and the next write into one of them copies
+    it first. Reads are sliced with memoryviews, so a read copies the
+    contents only once, into the bytes it returns.
+
+    Small writes which continue one another are collected in tail, and only
+    get written into the blocks once a block is full or something else needs
+    the contents, so a block is not copied again for every small write. The
+    version changes with every write and truncate.
+
+    The lock is for the callers, it has to be held while the contents are used
+    from more than one thread.
+    """
+
+    __slots__ = (
+        "blocks",
+        "stored",
+        "dirty",
+        "size",
+        "store",
+        "lock",
+        "version",
+        "tail",
+        "tailoffset",
+        "frozen",
+    )
+
+    def __init__(self, content=b""):
+        self.blocks = {}
+        self.stored = {}
+        self.dirty = set()
+        self.size = 0
+        self.store = None
+        self.lock = threading.Lock()
+        self.version = 0
+        self.tail = None
+        self.tailoffset = 0
+        self.frozen = set()
+        if content:
+            self.write(content, 0)
+
+    @classmethod
+    def from_legacy(cls, value):
+        "Converts the value from an older storage (bytes or str) to a ChunkedFile"
+        if isinstance(value, cls):
+            return value
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        return cls(value)
+
+    def __len__(self):
+        return self.size
+
+    def block(self, index):
+        "Returns the bytes of the block at index, decrypting it if required"
+        block = self.blocks.get(index)
+        if block is None:
+            if index not in self.stored:
+                return b""
+            block = self.store.block(self.stored[index])
+        return block
+
+    def setblock(self, index, block):
+        self.unstore(index)
+        if iszero(block):
+            self.blocks.pop(index, None)
+            self.dirty.discard(index)
+        else:
+            self.blocks[index] = block
+            self.dirty.add(index)
+
+    def unstore(self, index):
+        "Drops the reference to the stored block at index"
+        digest = self.stored.pop(index, None)
+        if digest is not None:
+            self.store.unref(digest)
+
+    def indexes(self):
+        "Returns the sorted indexes of all the blocks which are not holes"
+        return sorted(self.blocks.keys() | self.stored.keys())
+
+    def allocated(self):
+        """
+        Returns about how many bytes the blocks which are not holes hold, for
+        st_blocks. A dirty block is never stored, so they are counted once.
+        """
+        count = len(self.blocks) + len(self.stored)
+        tail = self.tail
+        if tail is not None:
+            index = self.tailoffset // BLOCK_SIZE
+            if index not in self.blocks and index not in self.stored:
+                count += 1
+        return min(count * BLOCK_SIZE, self.size)
+
+    def read(self, size, offset):
+        "Returns at most size bytes starting from the offset"
+        self.settle()
+        end = min(offset + size, self.size)
+        if self.stored and end - offset > BLOCK_SIZE:
+            # The blocks get decrypted together, on the workers of the store
+            self.store.prefetch(
+                self.stored[index]
+                for index in range(offset // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1)
+                if index in self.stored
+            )
+        # Inside of one bytes block, its slice is the only copy
+        single = end - offset <= BLOCK_SIZE - offset % BLOCK_SIZE
+        parts = []
+        position = offset
+        while position < end:
+            index, start = divmod(position, BLOCK_SIZE)
+            count = min(BLOCK_SIZE - start, end - position)
+            block = self.block(index)
+            if single and type(block) is bytes:
+                piece = block[start : start + count]
+            else:
+                piece = memoryview(block)[start : start + count]
+            parts.append(piece)
+            if len(piece) < count:
+                parts.append(ZERO[: count - len(piece)])
+            position += count
+        return b"".join(parts)
+
+    def write(self, data, offset):
+        "Writes data at the given offset, returns the number of bytes written"
+        length = len(data)
+        self.version += 1
+        if self.tail is not None and offset == self.tailoffset + len(self.tail):
+            self.tail += data
+        else:
+            self.settle()
+            if length >= BLOCK_SIZE:
+                self.writeblocks(data, offset)
+            else:
+                self.tail = bytearray(data)
+                self.tailoffset = offset
+        self.size = max(self.size, offset + length)
+        # Write the tail out once it reaches into the next block
+        if self.tail is not None and (
+            self.tailoffset // BLOCK_SIZE
+            != (self.tailoffset + len(self.tail)) // BLOCK_SIZE
+        ):
+            self.settle()
+        return length
+
+    def settle(self):
+        "Writes the collected small writes into the blocks"
+        if self.tail is not None:
+            tail, self.tail = self.tail, None
+            self.writeblocks(tail, self.tailoffset)
+
+    def writeblocks(self, data, offset):
+        "Writes data into the blocks at the given offset"
+        length = len(data)
+        view = memoryview(data)
+        position = 0
+        while position < length:
+            index, start = divmod(offset + position, BLOCK_SIZE)
+            count = min(BLOCK_SIZE - start, length - position)
+            end = start + count
+            piece = view[position : position + count]
+            block = self.blocks.get(index)
+            if start == 0 and count == BLOCK_SIZE:
+                # A whole block, a write of exactly one block keeps its bytes
+                block = (
+                    data if length == count and type(data) is bytes else bytes(piece)
+                )
+            elif type(block) is bytearray and index not in self.frozen:
+                if len(block) < end:
+                    block.extend(ZEROVIEW[: end - len(block)])
+                block[start:end] = piece
+            else:
+                old = self.block(index)
+                block = bytearray(max(len(old), end))
+                block[: len(old)] = old
+                block[start:end] = piece
+            self.setblock(index, block)
+            position += count
+
+    def truncate(self, length):
+        "Cuts or extends the file to the given length"
+        self.settle()
+        self.version += 1
+        if length < self.size:
+            index, start = divmod(length, BLOCK_SIZE)
+            for key in [key for key in self.indexes() if key >= index]:
+                if key == index and start:
+                    self.setblock(key, self.block(key)[:start])
+                else:
+                    self.blocks.pop(key, None)
+                    self.unstore(key)
+                    self.dirty.discard(key)
+        self.size = length
+
+    def snapshot(self):
+        """
+        Returns a copy to save on disk, with the dirty blocks and the digests
+        of the stored ones. The blocks are shared with the snapshot, and get
+        copied by the next write into them, see frozen. The store has to be
+        held while the snapshot is used, so that the stored digests stay valid.
+        """
+        self.settle()
+        self.frozen = set(self.dirty)
+        copy = ChunkedFile()
+        copy.blocks = {key: self.blocks[key] for key in self.dirty}
+        copy.stored = dict(self.stored)
+        copy.dirty = set(self.dirty)
+        copy.size = self.size
+        copy.store = self.store
+        return copy
+
+    def saved(self, snapshot, digests, store):
+        """
+        Records the digests of the dirty blocks of the snapshot after they got
+        stored. The block is handed over to the store. A block which was
+        changed again after the snapshot was taken stays dirty.
+        """
+        self.store = store
+        # Only one snapshot is taken at a time, it is not used any more
+        self.frozen.clear()
+        for key, digest in digests.items():
+            if key not in self.dirty or self.blocks[key] is not snapshot.blocks[key]:
+                continue
+            self.dirty.discard(key)
+            store.ref(digest, self.blocks.pop(key))
+            self.stored[key] = digest
+
+    def drop(self):
+        "Drops the references to all the stored blocks, once the file is gone"
+        for key in list(self.stored):
+            self.unstore(key)
+
+    def getvalue(self):
+        "Returns the whole content as bytes"
+        return self.read(self.size, 0)
@@ -0,0 +1,102 @@
+import threading
+import zlib
+from collections import namedtuple
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+# A codec compresses the plain text of a segment before it gets encrypted.
+# The id is saved in front of every segment, so it must never change.
+Codec = namedtuple("Codec", ["id", "name", "compress", "decompress"])
+
+NONE = Codec(0, "none", bytes, bytes)
+CODECS = {}
+
+# Only data which gets at least this much smaller is stored compressed
+MIN_RATIO = 0.9
+# Larger segments are only compressed if this much from their start does
+SAMPLE_SIZE = 4096
+
+
+def register(codec):
+    "Makes the codec usable for storing, and for reading what it stored"
+    CODECS[codec.id] = codec
+
+
+def codec(name):
+    "Returns the registered codec with the given name"
+    for value in CODECS.values():
+        if value.name == name:
+            return value
+    raise ValueError(f"Unknown compression {name}")
+
+
+register(NONE)
+register(Codec(1, "zlib", lambda data: zlib.compress(data, 1), zlib.decompress))
+if lzma is not None:
+    register(Codec(2, "lzma", lzma.compress, lzma.decompress))
+
+
+class Compressor:
+    """
+    Compresses segments with one codec, and keeps anything which does not
+    get smaller enough as it is.
+
+    A segment larger than two samples gets a sample from its start tried
+    first, so encrypted or already compressed files only cost a small try
+    for every block. Segments are read back with the codec they were stored
+    with, whichever codec is used for storing.
+    """
+
+    def __init__(self, name="zlib"):
+        self.codec = codec(name) if name else NONE
+        self.lock = threading.Lock()
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def worth(self, data):
+        "Tells if the sample of data compresses well enough"
+        if len(data) <= 2 * SAMPLE_SIZE:
+            return True
+        sample = data[:SAMPLE_SIZE]
+        return len(self.codec.compress(sample)) < len(sample) * MIN_RATIO
+
+    def pack(self, data):
+        "Returns the codec id followed by the compressed or the same data"
+        result = None
+        if self.codec is not NONE and self.worth(data):
+            result = self.codec.compress(data)
+            if len(result) >= len(data) * MIN_RATIO:
+                result = None
+        with self.lock:
+            self.bytes_in += len(data)
+            if result is None:
+                self.skipped += 1
+                self.bytes_out += len(data)
+            else:
+                self.compressed += 1
+                self.bytes_out += len(result)
+        if result is None:
+            return bytes((NONE.id,)) + data
+        return bytes((self.codec.id,)) + result
+
+    def unpack(self, data):
+        try:
+            codec = CODECS[data[0]]
+        except (IndexError, KeyError):
+            raise ValueError("Segment stored with an unknown compression")
+        return codec.decompress(data[1:])
+
+    def stats(self):
+        with self.lock:
+            return {
+                "codec": self.codec.name,
+                "compressed": self.compressed,
+                "skipped": self.skipped,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
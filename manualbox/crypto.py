@@ -0,0 +1,151 @@
+import base64
+import hashlib
+import hmac
+import os
+import struct
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+
+NONCE_SIZE = 12
+DIGEST_SIZE = 16
+
+# How the secret of a storage is made from the key the user gives. RAW keys
+# are Fernet keys, SCRYPT keys are passphrases.
+RAW, SCRYPT = 0, 1
+# The scrypt cost is 2 ** SCRYPT_COST, this takes about half a second
+SCRYPT_COST = 17
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+# The key derivation, the scrypt cost, r, p, the salt and the key check tag
+KEYHEADER = struct.Struct(">BBBB16s32s")
+
+
+def derive(secret, info):
+    "Derives a 32 bytes key for one purpose from the secret"
+    # cryptography before 3.1 needs the backend
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=info,
+        backend=default_backend(),
+    )
+    return hkdf.derive(secret)
+
+
+class KeyHeader:
+    """
+    How the secret of a storage is made from the key of the user, and a tag
+    which only the right secret reproduces.
+
+    The header is saved in plain text at the start of the storage, so a wrong
+    key is found out by deriving the secret and comparing one tag, before
+    anything else of the storage is read.
+    """
+
+    def __init__(self, kdf=RAW, cost=0, r=0, p=0, salt=b"", tag=b""):
+        self.kdf = kdf
+        self.cost = cost
+        self.r = r
+        self.p = p
+        self.salt = salt
+        self.tag = tag
+
+    @classmethod
+    def new(cls, key, cost=None):
+        """
+        Creates the header for a new storage and returns it with the secret.
+        With a cost, key is a passphrase for scrypt, else a Fernet key.
+        """
+        if cost is None:
+            header = cls(RAW, salt=os.urandom(SALT_SIZE))
+        else:
+            header = cls(SCRYPT, cost, SCRYPT_R, SCRYPT_P, os.urandom(SALT_SIZE))
+        secret = header.secret(key)
+        header.tag = header.check(secret)
+        return header, secret
+
+    @classmethod
+    def unpack(cls, data):
+        return cls(*KEYHEADER.unpack(data))
+
+    def pack(self):
+        return KEYHEADER.pack(self.kdf, self.cost, self.r, self.p, self.salt, self.tag)
+
+    def secret(self, key):
+        "Returns the 32 bytes secret made from key"
+        if self.kdf == RAW:
+            # This also makes sure that the key is a valid Fernet key
+            Fernet(key)
+            return base64.urlsafe_b64decode(key)
+        if self.kdf == SCRYPT:
+            kdf = Scrypt(
+                salt=self.salt,
+                length=32,
+                n=2**self.cost,
+                r=self.r,
+                p=self.p,
+                backend=default_backend(),
+            )
+            return kdf.derive(key)
+        raise ValueError("Storage with an unknown key derivation")
+
+    def check(self, secret):
+        "Returns the key check tag for the secret"
+        params = KEYHEADER.pack(self.kdf, self.cost, self.r, self.p, self.salt, b"")
+        return hmac.new(
+            derive(secret, b"manualbox key check"), params, hashlib.sha256
+        ).digest()
+
+    def unlock(self, key):
+        "Returns the secret, raises InvalidToken if key is not the right one"
+        secret = self.secret(key)
+        if not hmac.compare_digest(self.check(secret), self.tag):
+            raise InvalidToken
+        return secret
+
+
+class SegmentCipher:
+    """
+    Encrypts every segment with AES-256-GCM, without any base64 encoding.
+
+    A segment is the nonce, the ciphertext and the tag. The header of the
+    storage and the kind of the segment (a file block, the index, a journal
+    commit) are authenticated with it, so one kind of segment cannot be passed
+    off as another. The AES key is derived from the secret of the storage,
+    see KeyHeader, with HKDF.
+
+    Blocks are also named by a keyed BLAKE2b digest of their contents, with
+    its own key from HKDF, so that equal blocks are stored once without the
+    digests telling anything to somebody without the key.
+    """
+
+    def __init__(self, secret, header):
+        self.prefix = header
+        self.aead = AESGCM(derive(secret, b"manualbox storage segments"))
+        self.digestkey = derive(secret, b"manualbox block digests")
+
+    def encrypt(self, data, kind):
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.aead.encrypt(nonce, data, self.prefix + bytes((kind,)))
+
+    def digest(self, data):
+        return hashlib.blake2b(
+            data, digest_size=DIGEST_SIZE, key=self.digestkey
+        ).digest()
+
+    def decrypt(self, token, kind):
+        "Raises InvalidToken, same as Fernet, for a wrong key or changed data"
+        try:
+            return self.aead.decrypt(
+                token[:NONCE_SIZE], token[NONCE_SIZE:], self.prefix + bytes((kind,))
+            )
+        except (InvalidTag, ValueError):
+            raise InvalidToken
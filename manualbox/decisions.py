@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict
+from time import monotonic
+
+
+class DecisionCache:
+    """
+    Remembers the answers of the user for a while.
+
+    At most maxsize answers are kept, the least recently used one is dropped
+    first. An allowed key stays valid for ttl seconds after its last use, a
+    denied key for ttl seconds after the answer. Expired answers are removed
+    by a background timer every sweep_interval seconds, lookups never look at
+    the clock.
+
+    onexpire gets called from the timer with the keys of the allowed answers
+    which expired or were dropped, so that anything cached for them can go.
+    It is a weakref.WeakMethod, so that the timer does not keep the object
+    of the method alive.
+    """
+
+    def __init__(self, maxsize=4096, ttl=30, sweep_interval=1):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.records = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sweeper = None
+        self.onexpire = None
+        # Allowed keys dropped for space, they are passed on by the next sweep
+        self.dropped = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key):
+        "Returns the recorded answer for key (True or False), or None"
+        with self.lock:
+            record = self.records.get(key)
+            if record is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.records.move_to_end(key)
+            allow = record[1]
+            if allow:
+                self.records[key] = (monotonic(), True)
+            return allow
+
+    def peek(self, key):
+        "Same as get, but does not count as a use of the key"
+        with self.lock:
+            record = self.records.get(key)
+            return None if record is None else record[1]
+
+    def put(self, key, allow):
+        with self.lock:
+            self.records[key] = (monotonic(), allow)
+            self.records.move_to_end(key)
+            while len(self.records) > self.maxsize:
+                key, (_, allowed) = self.records.popitem(last=False)
+                if allowed:
+                    self.dropped.append(key)
+
+    def sweep(self):
+        "Removes every expired answer"
+        deadline = monotonic() - self.ttl
+        with self.lock:
+            expired = [
+                key for key, (when, _) in self.records.items() if when < deadline
+            ]
+            allowed, self.dropped = self.dropped, []
+            for key in expired:
+                if self.records.pop(key)[1]:
+                    allowed.append(key)
+        callback = self.onexpire() if self.onexpire is not None else None
+        if allowed and callback is not None:
+            callback(allowed)
+
+    def start(self):
+        "Starts the background timer which removes the expired answers"
+        if self.sweeper is None:
+            # Every timer gets its own event, so that a stopped one never
+            # runs on after a new start
+            self.stopped = threading.Event()
+            self.sweeper = threading.Thread(
+                target=self.run, args=(self.stopped,), daemon=True
+            )
+            self.sweeper.start()
+
+    def run(self, stopped):
+        while not stopped.wait(self.sweep_interval):
+            self.sweep()
+
+    def stop(self):
+        self.stopped.set()
+        self.sweeper = None
+
+    def stats(self):
+        "Returns the counters as a dictionary"
+        return {
+            "entries": len(self.records),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,613 @@
+import logging
+import os
+import platform
+import threading
+import weakref
+from collections import defaultdict
+from errno import EEXIST, EINVAL, EIO, EISDIR, ENOENT, ENOTDIR, ENOTEMPTY
+from pathlib import Path
+from stat import S_IFDIR, S_IFLNK, S_IFREG, S_ISLNK
+from time import time
+
+from .blockcache import CACHE_SIZE
+from .checkpoint import Checkpointer
+from .chunks import ChunkedFile
+from .decisions import DecisionCache
+from .fuseapi import FuseOSError, Operations, fuse_get_context
+from .handles import HandleTable
+from .inodes import InodeTable
+from .procinfo import ProcessCache
+from .stats import Stats, StatsMixIn
+from .storage import VaultStore
+
+
+class ManualBoxFS(StatsMixIn, Operations):
+    """
+    ManualBoxFS will stay on memory till it is closed.
+
+    FUSE can call us from many threads. The metadata lock guards the inode
+    table, data and the changes, and every ChunkedFile has its own
+    lock for the contents. A file lock can be taken while holding the metadata
+    lock, but never the other way round.
+    """
+
+    error = True
+    store = None
+
+    # These operations take the locks themselves, so that reading and writing
+    # file contents, or waiting for the user to answer, does not stop others.
+    unlocked = {"destroy", "init", "open", "read", "release", "truncate", "write"}
+
+    def __init__(
+        self,
+        key=b"",
+        mountpath="",
+        storagepath="",
+        callback=None,
+        access_ttl=30,
+        access_cache_size=4096,
+        checkpoint_interval=60,
+        checkpoint_dirty_bytes=64 * 1024 * 1024,
+        compression="zlib",
+        passphrase_cost=None,
+        workers=None,
+        cache_size=CACHE_SIZE,
+    ):
+        self.callback = callback
+        self.platform = platform.system()
+        self.mountpath = mountpath
+        # The metadata and the names of everything, and the contents by inode number
+        self.table = InodeTable()
+        self.data = defaultdict(ChunkedFile)
+        # Every open file, reads and writes on a handle skip the path lookup
+        self.handles = HandleTable()
+        # Contents of removed files which are still open
+        self.orphans = set()
+        # The following holds if the user granted access or not for a
+        # path:pid unique key.
+        self.decisions = DecisionCache(maxsize=access_cache_size, ttl=access_ttl)
+        self.decisions.onexpire = weakref.WeakMethod(self.expired)
+        # Set by FUSE while the filesystem is mounted
+        self.mounted = False
+        # Numbers for every operation, readable from /.manualbox/stats in the mount
+        self.stats = Stats()
+        self.stats.sources["decisions"] = self.decisions.stats
+        self.stats.sources["handles"] = self.handles.stats
+        self.processes = ProcessCache()
+        self.lock = threading.RLock()
+        # Only one question to the user at a time
+        self.questionlock = threading.Lock()
+        # Inodes and (directory, name) entries with changes which are not yet
+        # saved on disk
+        self.changed = set()
+        self.changednames = set()
+        self.dirtybytes = 0
+        # Only one save at a time, the background checkpoints included
+        self.savelock = threading.Lock()
+        self.checkpointer = Checkpointer(
+            self, interval=checkpoint_interval, dirty_bytes=checkpoint_dirty_bytes
+        )
+        # This is where we store the encrypted data.
+        self.storagepath = storagepath
+        try:
+            self.store = VaultStore(
+                self.storagepath,
+                key,
+                compression=compression,
+                passphrase_cost=passphrase_cost,
+                workers=workers,
+                cache_size=cache_size,
+            )
+            self.stats.sources["compression"] = self.store.compressor.stats
+            self.stats.sources["storage"] = self.store.stats
+            # Only the index gets decrypted here, file blocks are decrypted on read
+            stored = self.store.load()
+            if stored:
+                self.restore(*stored)
+            else:
+                self.table.root()
+        except BaseException:
+            # A wrong key, the threads and files must not stay behind
+            self.close()
+            raise
+        self.decisions.start()
+        self.error = False
+
+    def restore(self, metadata, data, updates):
+        "Sets up the inode table and the contents from what the store loaded"
+        if not self.store.legacy:
+            self.table = InodeTable.load(metadata, updates)
+            self.data = data
+            return
+        # The older format has everything by path
+        self.table = InodeTable.from_legacy(metadata)
+        for path, chunked in data.items():
+            ino = self.table.lookup(path)
+            if ino is not None:
+                self.data[ino] = chunked
+
+    def init(self, path):
+        "Called by FUSE once the filesystem is mounted"
+        self.mounted = True
+        self.decisions.start()
+        self.checkpointer.start()
+
+    def destroy(self, path):
+        "Called by FUSE when the filesystem gets unmounted"
+        self.mounted = False
+        self.checkpointer.stop()
+        self.decisions.stop()
+
+    def close(self):
+        """
+        Stops the background threads, closes the storage and forgets every
+        decrypted block. Save first, the filesystem can not be used after this.
+        """
+        self.error = True
+        self.mounted = False
+        self.checkpointer.stop()
+        self.decisions.stop()
+        self.processes.clear()
+        self.data = defaultdict(ChunkedFile)
+        if self.store is not None:
+            self.store.close()
+
+    def __call__(self, op, *args):
+        if op in self.unlocked:
+            return super().__call__(op, *args)
+        with self.lock:
+            return super().__call__(op, *args)
+
+    def lookup(self, path):
+        "Returns the inode number of path, raises ENOENT if there is none"
+        ino = self.table.lookup(path)
+        if ino is None:
+            raise FuseOSError(ENOENT)
+        return ino
+
+    def entry(self, path):
+        "Returns the inode number of the directory of path and the name in there"
+        parent, name = self.table.split(path)
+        if parent is None:
+            raise FuseOSError(ENOENT)
+        if not self.table.isdir(parent):
+            raise FuseOSError(ENOTDIR)
+        return parent, name
+
+    def resolve(self, path, fh):
+        "Returns the inode number and the contents, from the handle if it is open"
+        handle = self.handles.get(fh)
+        if handle is not None:
+            return handle.ino, handle.chunked
+        with self.lock:
+            ino = self.lookup(path)
+            return ino, self.contents(ino)
+
+    def contents(self, ino):
+        "Returns the contents of the inode, raises EISDIR for a directory"
+        # The defaultdict would give a directory contents of its own
+        if self.table.isdir(ino):
+            raise FuseOSError(EISDIR)
+        return self.data[ino]
+
+    def accesskey(self, path):
+        "Returns the calling process and its decision key for path, or None twice"
+        uid, gid, pid = fuse_get_context()
+        identity = self.processes.identity(pid)
+        if identity is None:
+            return None, None
+        return identity, f"{path}:{pid}:{identity.started}"
+
+    def keepcache(self, fh):
+        """
+        Tells if the kernel may keep the cached pages of the file over this
+        open. Only a process which is allowed to read the file already gets
+        them, for anybody else the kernel drops them, and the reads come here.
+        """
+        return bool(self.approved(self.handles.get(fh)))
+
+    def expired(self, keys):
+        "Called when the answers for keys expired, the next reads must ask again"
+        if not self.mounted or not hasattr(os, "posix_fadvise"):
+            return
+        for path in {key.rsplit(":", 2)[0] for key in keys}:
+            self.invalidate(path)
+
+    def invalidate(self, path):
+        "Drops the pages of path from the page cache of the kernel"
+        try:
+            fd = os.open(
+                os.path.join(self.mountpath, path[1:]), os.O_RDONLY | os.O_NONBLOCK
+            )
+        except OSError:
+            return
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def approved(self, handle):
+        "Tells if the user allowed the reads on handle, and the answer is still valid"
+        return (
+            handle is not None
+            and handle.key is not None
+            and self.decisions.get(handle.key)
+        )
+
+    def link(self, parent, name, ino):
+        "Records that name inside of the directory parent points to the inode now"
+        self.table.link(parent, name, ino)
+        self.changed.add(ino)
+        self.changednames.add((parent, name))
+
+    def unlinkentry(self, parent, name):
+        "Removes name, and its inode together with the contents once nothing links to it"
+        ino = self.table.unlink(parent, name)
+        self.table.nlink[ino] -= 1
+        if self.table.isdir(ino) or self.table.nlink[ino] <= 0:
+            self.table.remove(ino)
+            chunked = self.data.pop(ino, None)
+            if chunked is not None:
+                self.forget(chunked)
+        self.changed.add(ino)
+        self.changednames.add((parent, name))
+
+    def replace(self, parent, name):
+        "Removes a file which is in the way of a new one with the same name"
+        existing = self.table.entries[parent].get(name)
+        if existing is not None:
+            if self.table.isdir(existing):
+                raise FuseOSError(EISDIR)
+            self.unlinkentry(parent, name)
+
+    def forget(self, chunked):
+        "Drops the stored blocks of removed contents, once no handle has them open"
+        if self.handles.isopen(chunked):
+            self.orphans.add(chunked)
+            return
+        self.orphans.discard(chunked)
+        with chunked.lock:
+            chunked.drop()
+
+    def chmod(self, path, mode):
+        ino = self.lookup(path)
+        self.table.mode[ino] &= 0o770000
+        self.table.mode[ino] |= mode
+        self.changed.add(ino)
+        return 0
+
+    def chown(self, path, uid, gid):
+        ino = self.lookup(path)
+        self.table.uid[ino] = uid
+        self.table.gid[ino] = gid
+        self.changed.add(ino)
+
+    def create(self, path, mode):
+        parent, name = self.entry(path)
+        self.replace(parent, name)
+        ino = self.table.new(S_IFREG | mode)
+        self.link(parent, name, ino)
+        return self.handles.open(ino, self.data[ino])
+
+    def flush(self, path, fh):
+        return 0
+
+    def getattr(self, path, fh=None):
+        ino = self.lookup(path)
+        # Directories have no contents, and must not get any from the defaultdict
+        chunked = self.data.get(ino)
+        return self.table.stat(ino, chunked.allocated() if chunked else 0)
+
+    def getxattr(self, path, name, position=0):
+        attrs = self.table.attrs.get(self.lookup(path), {})
+
+        try:
+            return attrs[name]
+        except KeyError:
+            return ""  # Should return ENOATTR
+
+    def listxattr(self, path):
+        attrs = self.table.attrs.get(self.lookup(path), {})
+        return attrs.keys()
+
+    def mkdir(self, path, mode):
+        parent, name = self.entry(path)
+        if name in self.table.entries[parent]:
+            raise FuseOSError(EEXIST)
+        ino = self.table.new(S_IFDIR | mode, nlink=2)
+        self.table.nlink[parent] += 1
+        self.changed.add(parent)
+        self.link(parent, name, ino)
+
+    def open(self, path, flags):
+        with self.lock:
+            ino = self.lookup(path)
+            fd = self.handles.open(ino, self.contents(ino))
+
+        # A process which is allowed already reads without asking, see keepcache
+        identity, key = self.accesskey(path)
+        if key is not None and self.decisions.peek(key):
+            self.handles.get(fd).key = key
+
+        # In Mac, we found that it is doing the open call every time, but not the read call.
+        # The following will make sure that the user input happens in that case, but, sadly it
+        # also means that user input will be required.
+        if self.platform == "Darwin":
+            with self.stats.timed("manualquestion"):
+                result = self.manualquestion(path, fd)
+            if not result:
+                self.handles.release(fd)
+                raise FuseOSError(EIO)
+        return fd
+
+    def read(self, path, size, offset, fh):
+        """
+        This method helps to read any file. We intercept this syscall in our project.
+        """
+        handle = self.handles.get(fh)
+        # We need the display with the correct mount path
+        if self.platform != "Darwin" and not self.approved(handle):
+            with self.stats.timed("manualquestion"):
+                result = self.manualquestion(path, fh)
+            if not result:
+                raise FuseOSError(EIO)
+        if handle is not None:
+            return handle.read(size, offset)
+        with self.lock:
+            chunked = self.contents(self.lookup(path))
+        with chunked.lock:
+            return chunked.read(size, offset)
+
+    def release(self, path, fh):
+        handle = self.handles.release(fh)
+        if handle is not None and handle.chunked in self.orphans:
+            with self.lock:
+                if handle.chunked in self.orphans:
+                    self.forget(handle.chunked)
+        return 0
+
+    def readdir(self, path, fh):
+        ino = self.lookup(path)
+        if not self.table.isdir(ino):
+            raise FuseOSError(ENOTDIR)
+        names = [".", ".."]
+        names.extend(self.table.entries.get(ino, {}))
+        return names
+
+    def readlink(self, path):
+        ino = self.lookup(path)
+        if not S_ISLNK(self.table.mode[ino]):
+            raise FuseOSError(EINVAL)
+        chunked = self.data[ino]
+        with chunked.lock:
+            return chunked.getvalue().decode("utf-8")
+
+    def removexattr(self, path, name):
+        ino = self.lookup(path)
+        attrs = self.table.attrs.get(ino, {})
+
+        try:
+            del attrs[name]
+        except KeyError:
+            pass  # Should return ENOATTR
+        self.changed.add(ino)
+
+    def rename(self, old, new):
+        "Moves only the name, whatever is inside of a directory moves with it"
+        oldparent, oldname = self.entry(old)
+        ino = self.table.entries[oldparent].get(oldname)
+        if ino is None:
+            raise FuseOSError(ENOENT)
+        if new == old:
+            return
+        # A directory cannot go inside of itself
+        if new.startswith(old + "/"):
+            raise FuseOSError(EINVAL)
+        newparent, newname = self.entry(new)
+        existing = self.table.entries[newparent].get(newname)
+        if existing is not None:
+            if self.table.isdir(existing):
+                if not self.table.isdir(ino):
+                    raise FuseOSError(EISDIR)
+                if self.table.entries[existing]:
+                    raise FuseOSError(ENOTEMPTY)
+                self.table.nlink[newparent] -= 1
+            elif self.table.isdir(ino):
+                raise FuseOSError(ENOTDIR)
+            self.unlinkentry(newparent, newname)
+        self.table.unlink(oldparent, oldname)
+        self.table.link(newparent, newname, ino)
+        if self.table.isdir(ino):
+            self.table.nlink[oldparent] -= 1
+            self.table.nlink[newparent] += 1
+        self.changed.update((ino, oldparent, newparent))
+        self.changednames.update(((oldparent, oldname), (newparent, newname)))
+
+    def rmdir(self, path):
+        parent, name = self.entry(path)
+        ino = self.table.entries[parent].get(name)
+        if ino is None:
+            raise FuseOSError(ENOENT)
+        if not self.table.isdir(ino):
+            raise FuseOSError(ENOTDIR)
+        if self.table.entries[ino]:
+            raise FuseOSError(ENOTEMPTY)
+        self.unlinkentry(parent, name)
+        self.table.nlink[parent] -= 1
+        self.changed.add(parent)
+
+    def setxattr(self, path, name, value, options, position=0):
+        # Ignore options
+        ino = self.lookup(path)
+        self.table.attrs.setdefault(ino, {})[name] = value
+        self.changed.add(ino)
+
+    def statfs(self, path):
+        """
+        We return the stat of the home directory of the user.
+        """
+        st = os.statvfs(Path.home())
+        result = {
+            "f_bsize": st.f_bsize,
+            "f_frsize": st.f_frsize,
+            "f_blocks": st.f_blocks,
+            "f_bfree": st.f_bfree,
+            "f_bavail": st.f_bavail,
+            "f_files": st.f_files,
+            "f_ffree": st.f_ffree,
+            "f_favail": st.f_favail,
+            "f_flag": st.f_flag,
+            "f_namemax": st.f_namemax,
+        }
+        return result
+
+    def symlink(self, target, source):
+        parent, name = self.entry(target)
+        self.replace(parent, name)
+        content = source.encode("utf-8")
+        ino = self.table.new(S_IFLNK | 0o777, size=len(content))
+        self.data[ino] = ChunkedFile(content)
+        self.link(parent, name, ino)
+
+    def truncate(self, path, length, fh=None):
+        ino, chunked = self.resolve(path, fh)
+        with chunked.lock:
+            # extending the file reads back as zero bytes
+            chunked.truncate(length)
+        with self.lock:
+            if self.data.get(ino) is chunked:
+                self.table.size[ino] = len(chunked)
+                self.changed.add(ino)
+
+    def unlink(self, path):
+        parent, name = self.table.split(path)
+        if parent is not None and name in self.table.entries.get(parent, {}):
+            if self.table.isdir(self.table.entries[parent][name]):
+                raise FuseOSError(EISDIR)
+            self.unlinkentry(parent, name)
+
+    def utimens(self, path, times=None):
+        now = time()
+        atime, mtime = times if times else (now, now)
+        ino = self.lookup(path)
+        self.table.atime[ino] = atime
+        self.table.mtime[ino] = mtime
+        self.changed.add(ino)
+
+    def write(self, path, data, offset, fh):
+        ino, chunked = self.resolve(path, fh)
+        with chunked.lock:
+            try:
+                # only the blocks covered by this write are touched
+                chunked.write(data, offset)
+                failed = False
+            except Exception:
+                logging.exception(
+                    f"Writing {len(data)} bytes at {offset} of {path} failed"
+                )
+                failed = True
+        # The size is read again here, so the last writer always leaves the right one
+        with self.lock:
+            # The file might have been removed meanwhile, and its inode used again
+            if self.data.get(ino) is chunked:
+                # A failed write may still have changed some of the blocks
+                self.table.size[ino] = len(chunked)
+                self.changed.add(ino)
+            if failed:
+                raise FuseOSError(EIO)
+            self.dirtybytes += len(data)
+        self.checkpointer.written(self.dirtybytes)
+        return len(data)
+
+    def __del__(self):
+        self.close()
+
+    def saveondisk(self):
+        "We will have to save the Filesystem on disk here."
+        # This is incase of an error in decryption of the ~/.manualbox
+        if self.error:
+            return
+
+        with self.savelock:
+            # Take a snapshot, this is the only part which holds up other operations
+            with self.lock:
+                compact = self.store.needscompaction()
+                if not (compact or self.changed or self.changednames):
+                    return
+                # The stored blocks of the snapshot must stay till it is saved
+                self.store.hold()
+                changed, self.changed = self.changed, set()
+                changednames, self.changednames = self.changednames, set()
+                self.dirtybytes = 0
+                if compact:
+                    metadata = self.table.dump()
+                else:
+                    update = self.table.changes(changednames, changed)
+                live = {
+                    ino: self.data[ino]
+                    for ino in (self.data if compact else changed)
+                    if ino in self.data
+                }
+                snapshots = {}
+                for ino, chunked in live.items():
+                    with chunked.lock:
+                        snapshots[ino] = chunked.snapshot()
+
+            try:
+                if compact:
+                    saved = self.store.compact(metadata, snapshots)
+                else:
+                    # Only the changes get written, into the journal next to the storage
+                    saved = self.store.append(update, snapshots, changed)
+            except BaseException:
+                with self.lock:
+                    self.changed |= changed
+                    self.changednames |= changednames
+                self.store.release()
+                raise
+
+            with self.lock:
+                for ino, digests in saved.items():
+                    chunked = live[ino]
+                    with chunked.lock:
+                        chunked.saved(snapshots[ino], digests, self.store)
+                self.store.release()
+
+    def manualquestion(self, path, fh):
+        """
+        Creates the user input dialog for the given path
+        """
+        logging.debug(f"manualquestion is called for {path} with {fh}")
+
+        # Now let us find the process information, this is cached and does not
+        # read /proc again for a process we already know.
+        identity, key = self.accesskey(path)
+        if identity is None:
+            # The process is not there, return now
+            return False
+
+        handle = self.handles.get(fh)
+        if handle is not None:
+            # Later reads on the handle only check that this answer is still there
+            handle.key = key
+        allow = self.decisions.get(key)
+        if allow is None:
+            with self.questionlock:
+                # The user might have answered for this key while we waited
+                allow = self.decisions.peek(key)
+                if allow is None:
+                    # The name is only needed to ask the user
+                    process_name = self.processes.name(identity)
+                    if not process_name:
+                        return False
+                    display_path = os.path.join(self.mountpath, path[1:])
+                    try:
+                        result = self.callback(display_path, process_name)
+                    except:
+                        result = None
+                    allow = result == "okay"
+                    # store the value for the next read call
+                    self.decisions.put(key, allow)
+        return allow
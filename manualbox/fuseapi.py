@@ -0,0 +1,45 @@
+"""
+The parts of fusepy ManualBox uses.
+
+fusepy raises OSError at import when libfuse is not installed. The storage
+and manualbox import/export work without a mount, so then FuseOSError and
+Operations are the same as the ones of fusepy, and only mounting fails, with
+the error fusepy gave.
+"""
+
+import os
+from errno import EFAULT
+
+try:
+    try:
+        # This is for Debian/Ubuntu
+        import fusepy as fuse
+    except ModuleNotFoundError:
+        import fuse
+except OSError as err:
+    fuse = None
+    NOLIBFUSE = str(err)
+
+if fuse is not None:
+    FUSE = fuse.FUSE
+    FuseOSError = fuse.FuseOSError
+    Operations = fuse.Operations
+    fuse_get_context = fuse.fuse_get_context
+else:
+
+    class FuseOSError(OSError):
+        def __init__(self, errno):
+            super().__init__(errno, os.strerror(errno))
+
+    class Operations:
+        def __call__(self, op, *args):
+            if not hasattr(self, op):
+                raise FuseOSError(EFAULT)
+            return getattr(self, op)(*args)
+
+    class FUSE:
+        def __init__(self, operations, mountpoint, **kwargs):
+            raise OSError(NOLIBFUSE)
+
+    def fuse_get_context():
+        raise OSError(NOLIBFUSE)
@@ -0,0 +1,386 @@
+# -*- coding: utf-8 -*-
+import binascii
+import logging
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from . import manualboxinput
+from .broker import ApprovalBroker, SocketServer, newtoken
+from .crypto import SCRYPT_COST
+from .fs import ManualBoxFS
+from .profiles import mount
+from .storage import StorageInUse
+from .utils import get_asset_path
+from .version import VERSION
+from .widgets import MountEdit
+
+from PyQt5.QtGui import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtCore import *
+from PyQt5 import QtWidgets
+
+
+class FSThread(QThread):
+    def __init__(
+        self,
+        mountpath="",
+        password="",
+        nothreads=False,
+        profile="default",
+        approvalsocket=False,
+        passphrase_cost=None,
+    ):
+        QThread.__init__(self)
+        self.mountpath = mountpath
+        self.nothreads = nothreads
+        self.profile = profile
+        home = str(Path.home())
+        storagepath = os.path.join(home, ".manualbox")
+        key = password.encode("utf-8")
+        # The questions go to the dialog, and to the clients of the socket
+        # if the user asked for it. Only a client with the token of this
+        # session gets them.
+        self.broker = ApprovalBroker()
+        self.server = None
+        self.token = newtoken() if approvalsocket else None
+        self.fs = ManualBoxFS(
+            key=key,
+            mountpath=self.mountpath,
+            storagepath=storagepath,
+            callback=self.broker.ask,
+            passphrase_cost=passphrase_cost,
+        )
+        self.fs.stats.sources["approvals"] = self.broker.stats
+
+    def run(self):
+        if self.token is not None:
+            try:
+                self.server = SocketServer(self.broker, token=self.token)
+                self.server.start()
+            except OSError as err:
+                logging.warning(f"The approval socket is not available: {err}")
+                self.server = None
+        try:
+            self.fuse = mount(
+                self.fs, self.mountpath, profile=self.profile, nothreads=self.nothreads
+            )
+        except (ValueError, InvalidToken, binascii.Error):
+            print("Wrong key for the ~/.manualbox")
+        finally:
+            if self.server is not None:
+                self.server.stop()
+
+
+class MainUserWindow(QMainWindow):
+    # The questions of the broker, passed over from the filesystem threads
+    questionasked = pyqtSignal("PyQt_PyObject")
+    questionanswered = pyqtSignal("PyQt_PyObject")
+    CSS = """
+            QLabel#filepath {
+                color: black;
+                font-size: 25px;
+                background-color: rgb(255,255,255);
+            }
+            QPushButton#mountpathButton {
+                background-color: rgb(255,255,255);
+                font-size: 20px;
+            }
+            QPushButton#umountpathButton {
+                background-color: rgb(255,255,255);
+                font-size: 20px;
+            }
+            QPushButton {
+                background-color: rgb(255,255,255);
+            }
+
+
+    """
+
+    def __init__(self, parent=None):
+        self.home = str(Path.home())
+        self.path = os.path.join(self.home, "secured")
+        storagepath = os.path.join(self.home, ".manualbox")
+        self.mounted = False
+        super(MainUserWindow, self).__init__(parent)
+        self.layout = QVBoxLayout()
+
+        iconlabel = QLabel(pixmap=QPixmap(get_asset_path("mainicon.png")))
+        self.buttonslayout = QHBoxLayout()
+        self.buttonslayout.addWidget(iconlabel)
+
+        formlayout = QFormLayout()
+
+        mountpathLabel = QLabel("Mount path  (empty for default):")
+        self.mountpathTxt = MountEdit()
+
+        passwordlabel = QLabel("Password:")
+        self.passwordTxt = QLineEdit()
+        self.passwordTxt.setEchoMode(QLineEdit.Password)
+
+        # Only for a new storage, an existing one knows how its key is used
+        self.passphraseCheck = QCheckBox("The password is a passphrase")
+        self.passphraseCheck.setVisible(not os.path.exists(storagepath))
+        self.socketCheck = QCheckBox("Also answer with manualbox-approve")
+
+        formlayout.addRow(mountpathLabel, self.mountpathTxt)
+        formlayout.addRow(passwordlabel, self.passwordTxt)
+        formlayout.addRow(self.passphraseCheck)
+        formlayout.addRow(self.socketCheck)
+        form = QWidget()
+        form.setLayout(formlayout)
+
+        self.mountpathButton = QPushButton("Mount")
+        self.mountpathButton.setObjectName("mountpathButton")
+        self.mountpathButton.setFixedHeight(60)
+        self.mountpathButton.setFixedWidth(100)
+        self.mountpathButton.clicked.connect(self.mount)
+        self.umountpathButton = QPushButton("Unmount")
+        self.umountpathButton.setObjectName("umountpathButton")
+        self.umountpathButton.setFixedHeight(60)
+        self.umountpathButton.setFixedWidth(100)
+        self.umountpathButton.clicked.connect(self.unmount)
+        self.umountpathButton.hide()
+        self.buttonslayout.addWidget(form)
+
+        self.buttonslayout.addWidget(self.mountpathButton)
+        self.buttonslayout.addWidget(self.umountpathButton)
+        buttons = QWidget()
+        buttons.setLayout(self.buttonslayout)
+        self.layout.addWidget(buttons)
+        self.textarea = QTextEdit()
+        self.textarea.setReadOnly(True)
+        self.layout.addWidget(self.textarea)
+        mainw = QWidget()
+        mainw.setLayout(self.layout)
+        self.setCentralWidget(mainw)
+        self.setFixedWidth(900)
+        self.setFixedHeight(480)
+        self.fs = None
+        self.trayIcon = QSystemTrayIcon(self)
+        self.trayIcon.setIcon(QIcon(QPixmap(get_asset_path("trayicon.png"))))
+
+        self.quitAction = QAction("Exit", self)
+        self.quitAction.triggered.connect(self.handleQuit)
+        self.trayMenu = QMenu()
+        self.trayMenu.addAction(self.quitAction)
+        self.trayIcon.setContextMenu(self.trayMenu)
+        self.trayIcon.activated.connect(self.view_toggle)
+        self.trayIcon.show()
+        self.setStyleSheet(self.CSS)
+        self.setWindowTitle(f"ManualBox {VERSION}")
+
+        # One dialog is built ahead and shown for every question, the ones
+        # which come while it is open wait in the list.
+        self.dialog = manualboxinput.MainInput()
+        self.dialog.answered.connect(self.answerquestion)
+        self.questions = []
+        self.questionasked.connect(self.addquestion)
+        self.questionanswered.connect(self.dropquestion)
+
+        # now check if we have a ~/.manualbox
+        if not os.path.exists(storagepath):
+            msg = f"Creating a new ManualBox storage at: {storagepath}: "
+            self.addText(msg)
+
+            key = Fernet.generate_key()
+            key_text = key.decode("utf-8")
+            self.addText(f"Here is your new key, please store it securely: {key_text}")
+            self.addText(
+                "Click on Mount to use it, or type a passphrase instead and tick the passphrase box."
+            )
+            self.passwordTxt.setText(key_text)
+
+    def view_toggle(self, reason):
+        "To handle clicks on the tray icon"
+        if reason == 1:
+            self.trayMenu.show()
+            return
+        if self.isVisible():
+            self.hide()
+        else:
+            self.show()
+
+    def closeEvent(self, event):
+        "MainWindow closing event"
+        if not self.mounted:
+            qApp.quit()
+        else:
+            event.ignore()
+            self.hide()
+            self.trayIcon.showMessage(
+                "ManualBox",
+                "Application was minimized to Tray",
+                QSystemTrayIcon.Information,
+                2000,
+            )
+
+    def addText(self, newtext):
+        text = self.textarea.toPlainText() + "\n"
+        text += newtext
+        self.textarea.setText(text)
+
+    def handleQuit(self):
+        if self.mounted:
+            self.trayIcon.showMessage(
+                "ManualBox",
+                "Please unmount first and then quit.",
+                QSystemTrayIcon.Information,
+                5000,
+            )
+        else:
+            qApp.quit()
+
+    def msg_show(self, text):
+        self.trayIcon.showMessage("ManualBox", text, QSystemTrayIcon.Information, 2000)
+
+    def mount(self):
+        "Mounts the provided path"
+        self.path = str(self.mountpathTxt.text())
+        if not self.path:
+            self.path = os.path.join(self.home, "secured")
+            try:
+                os.mkdir(self.path)
+            except FileExistsError:
+                pass
+            self.mountpathTxt.setText(self.path)
+
+        # Now verify that the mount path exists
+        if not os.path.exists(self.path):
+            self.textarea.setText(
+                f'The mount path <font color="red"><b>{self.path}</b></font> does not exist.'
+            )
+            return
+        # Verify that the mount path is empty
+        if len(os.listdir(self.path)) != 0:
+            self.textarea.setText(
+                f'The mount path <font color="red"><b>{self.path}</b></font> is not empty. Please select an empty directory.'
+            )
+            return
+
+        password = str(self.passwordTxt.text())
+        cost = SCRYPT_COST if self.passphraseCheck.isChecked() else None
+
+        try:
+            self.fs = FSThread(
+                self.path,
+                password,
+                approvalsocket=self.socketCheck.isChecked(),
+                passphrase_cost=cost,
+            )
+        except StorageInUse:
+            self.textarea.setText(
+                "The ~/.manualbox storage is in use by another ManualBox. Please close it first."
+            )
+            return
+        except (ValueError, InvalidToken, binascii.Error):
+            if cost is None and not self.passphraseCheck.isHidden():
+                self.textarea.setText(
+                    "This is not a key, tick the passphrase box to use a passphrase."
+                )
+                return
+            self.textarea.setText(
+                "Wrong password for the ~/.manualbox storage. Please try again."
+            )
+            return
+        self.questions = []
+        self.fs.broker.subscribe(self)
+        self.fs.start()
+        self.mountpathButton.hide()
+        self.umountpathButton.show()
+        self.passwordTxt.setEnabled(False)
+        self.mountpathTxt.setEnabled(False)
+        self.socketCheck.setEnabled(False)
+        self.passphraseCheck.hide()
+        self.mounted = True
+        self.addText(f"Successfully decrypted and mounted at {self.path}")
+        if self.fs.token is not None:
+            self.addText(f"The token for manualbox-approve is: {self.fs.token}")
+        # On mac the UI is not updating properly otherwise
+        self.repaint()
+
+    def unmount(self):
+        "Unmounts the filesystem"
+        self.fs.fs.saveondisk()
+
+        try:
+            if self.fs.fs.platform == "Darwin":
+                subprocess.check_output(["diskutil", "unmount", self.path])
+            else:
+                subprocess.check_output(["fusermount", "-u", self.path])
+        except subprocess.CalledProcessError:
+            self.addText(
+                "Error while unmounting, please close any file browser opened on the mounted path and then try again."
+            )
+            return
+        # Saves what was written since, and drops the decrypted blocks
+        self.fs.wait()
+        self.fs.fs.saveondisk()
+        self.fs.fs.close()
+        self.textarea.setText(
+            """Unmounted successfully.
+
+Encrypting the data into the storage on disk.
+Encryption and storage is successful.
+To use again, please click on the Mount button."""
+        )
+        self.passwordTxt.setEnabled(True)
+        self.mountpathTxt.setEnabled(True)
+        self.socketCheck.setEnabled(True)
+        self.umountpathButton.hide()
+        self.mountpathButton.show()
+        self.mounted = False
+        self.repaint()
+
+    def asked(self, request):
+        "Called by the broker from a filesystem thread"
+        self.questionasked.emit(request)
+
+    def answered(self, request):
+        "Called by the broker from the thread which answered"
+        self.questionanswered.emit(request)
+
+    def addquestion(self, request):
+        self.questions.append(request)
+        if len(self.questions) == 1:
+            self.asktheuser(request)
+
+    def dropquestion(self, request):
+        "The question got answered, here or by a client of the socket"
+        if request not in self.questions:
+            return
+        current = self.questions[0] is request
+        self.questions.remove(request)
+        if current:
+            self.dialog.hide()
+            if self.questions:
+                self.asktheuser(self.questions[0])
+
+    def answerquestion(self, result):
+        if self.questions:
+            self.fs.broker.answer(self.questions[0].id, result)
+
+    def asktheuser(self, request):
+        logging.debug(f"ASKTHEUSER called with {request.display_path}")
+        self.msg_show(f"Accesing: {request.display_path}")
+        self.dialog.setrequest(request.display_path, request.process_name)
+        self.dialog.show()
+        self.dialog.setWindowState(Qt.WindowState.WindowActive)
+        self.dialog.raise_()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, filename="/dev/null")
+    app = QtWidgets.QApplication(sys.argv)
+    form = MainUserWindow()
+    form.show()
+    form.setWindowState(Qt.WindowState.WindowActive)
+    form.raise_()
+    app.exec_()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+import heapq
+import threading
+
+# Sequential reads on a handle fetch this much at once
+READAHEAD_SIZE = 128 * 1024
+
+
+class Handle:
+    """
+    State of one open file.
+
+    The inode and the contents are resolved once on open, and key is the
+    decision key of the last answer of the user, so that later reads only
+    have to check that the answer is still valid.
+
+    Reads which continue where the last one ended fetch READAHEAD_SIZE bytes,
+    and the next reads are served from that as long as the version of the
+    file did not change.
+    """
+
+    __slots__ = ("ino", "chunked", "key", "nextoffset", "readahead")
+
+    def __init__(self, ino, chunked):
+        self.ino = ino
+        self.chunked = chunked
+        self.key = None
+        self.nextoffset = 0
+        # (version, offset, bytes) of the last read from the file
+        self.readahead = None
+
+    def read(self, size, offset):
+        chunked = self.chunked
+        readahead = self.readahead
+        if readahead is not None:
+            version, start, data = readahead
+            end = start + len(data)
+            if (
+                version == chunked.version
+                and start <= offset
+                and (offset + size <= end or end >= chunked.size)
+            ):
+                self.nextoffset = offset + size
+                return data[offset - start : offset - start + size]
+        with chunked.lock:
+            if offset == self.nextoffset:
+                data = chunked.read(max(size, READAHEAD_SIZE), offset)
+                self.readahead = (chunked.version, offset, data)
+                data = data[:size]
+            else:
+                data = chunked.read(size, offset)
+        self.nextoffset = offset + size
+        return data
+
+
+class HandleTable:
+    """
+    Every open file by its handle number.
+
+    A number is only given out again after its handle was released, the
+    lowest free number first. users counts the handles of every ChunkedFile,
+    so that the contents of a removed file stay till it is closed.
+    """
+
+    def __init__(self):
+        self.handles = {}
+        self.free = []
+        self.users = {}
+        self.lock = threading.Lock()
+        self.opened = 0
+
+    def __len__(self):
+        return len(self.handles)
+
+    def get(self, fh):
+        "Returns the Handle for fh, or None if it is not open"
+        return self.handles.get(fh)
+
+    def open(self, ino, chunked):
+        "Creates a handle for the inode and returns its number"
+        with self.lock:
+            fh = heapq.heappop(self.free) if self.free else len(self.handles) + 1
+            self.handles[fh] = Handle(ino, chunked)
+            self.users[chunked] = self.users.get(chunked, 0) + 1
+            self.opened += 1
+            return fh
+
+    def release(self, fh):
+        "Frees the handle number and returns the Handle, or None"
+        with self.lock:
+            handle = self.handles.pop(fh, None)
+            if handle is not None:
+                heapq.heappush(self.free, fh)
+                count = self.users.pop(handle.chunked) - 1
+                if count:
+                    self.users[handle.chunked] = count
+            return handle
+
+    def isopen(self, chunked):
+        "Tells if any handle has the contents open"
+        return chunked in self.users
+
+    def stats(self):
+        return {"open": len(self.handles), "opened": self.opened}
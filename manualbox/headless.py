@@ -0,0 +1,175 @@
+import argparse
+import binascii
+import getpass
+import os
+import queue
+import sys
+import threading
+from pathlib import Path
+
+from cryptography.fernet import InvalidToken
+
+from .blockcache import CACHE_SIZE
+from .broker import NOPE, OKAY, ApprovalBroker, SocketServer, newtoken
+from .crypto import SCRYPT_COST
+from .fs import ManualBoxFS
+from .profiles import PROFILES, mount
+from .storage import StorageInUse
+
+
+class TerminalApprover:
+    """
+    Asks the questions on the terminal, one after another. A question which
+    got answered somewhere else while it waited is skipped.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.questions = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def asked(self, request):
+        self.questions.put(request)
+
+    def answered(self, request):
+        pass
+
+    def start(self):
+        self.broker.subscribe(self)
+        self.thread.start()
+
+    def stop(self):
+        self.broker.unsubscribe(self)
+
+    def run(self):
+        while True:
+            request = self.questions.get()
+            if request.answer is not None:
+                continue
+            try:
+                reply = input(
+                    f"Allow {request.process_name} to read {request.display_path}? [y/N] "
+                )
+            except EOFError:
+                return
+            self.broker.answer(request.id, OKAY if reply.lower() == "y" else NOPE)
+
+
+# Every way to answer the questions, by the name given on the command line
+APPROVERS = {
+    "socket": lambda broker, args: SocketServer(broker, args.socket, args.token),
+    "terminal": lambda broker, args: TerminalApprover(broker),
+}
+
+
+def readkey(args):
+    "Returns the key from the key file, the environment, or asks for it"
+    if args.key_file:
+        with open(args.key_file, "rb") as fobj:
+            return fobj.read().strip()
+    key = os.environ.get("MANUALBOX_KEY")
+    if key:
+        return key.encode("utf-8")
+    return getpass.getpass("Key or passphrase: ").encode("utf-8")
+
+
+def keyerror(storagepath):
+    "Tells why the key did not open the storage"
+    if os.path.exists(storagepath):
+        return f"Wrong key for {storagepath}"
+    return (
+        "The key is not a Fernet key, give --passphrase-cost to use a "
+        f"passphrase for the new {storagepath}"
+    )
+
+
+def main():
+    "Mounts a ManualBox without the desktop application"
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("mountpath", help="empty directory to mount on")
+    parser.add_argument(
+        "--storage",
+        default=os.path.join(str(Path.home()), ".manualbox"),
+        help="encrypted storage file (default: ~/.manualbox)",
+    )
+    parser.add_argument(
+        "--key-file", help="read the key from this file instead of $MANUALBOX_KEY"
+    )
+    parser.add_argument(
+        "--passphrase-cost",
+        type=int,
+        nargs="?",
+        const=SCRYPT_COST,
+        metavar="N",
+        help="a new storage takes the key as a passphrase for scrypt with cost 2**N"
+        f" (default N: {SCRYPT_COST})",
+    )
+    parser.add_argument(
+        "--approve",
+        action="append",
+        choices=sorted(APPROVERS),
+        help="how the accesses get answered, can be given more than once (default: socket)",
+    )
+    parser.add_argument("--socket", help="path of the approval socket")
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        help="deny an access which is not answered in this many seconds",
+    )
+    parser.add_argument(
+        "--profile",
+        default="default",
+        choices=sorted(PROFILES),
+        help="how much the kernel caches (default: default)",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=CACHE_SIZE // 2**20,
+        help=f"MiB of decrypted blocks kept in memory (default: {CACHE_SIZE // 2**20})",
+    )
+    parser.add_argument(
+        "--nothreads", action="store_true", help="let FUSE call in only one thread"
+    )
+    args = parser.parse_args()
+
+    broker = ApprovalBroker(timeout=args.timeout)
+    try:
+        fs = ManualBoxFS(
+            key=readkey(args),
+            mountpath=args.mountpath,
+            storagepath=args.storage,
+            callback=broker.ask,
+            cache_size=args.cache_size * 2**20,
+            passphrase_cost=args.passphrase_cost,
+        )
+    except StorageInUse as err:
+        print(err, file=sys.stderr)
+        return 1
+    except (ValueError, InvalidToken, binascii.Error):
+        print(keyerror(args.storage), file=sys.stderr)
+        return 1
+    fs.stats.sources["approvals"] = broker.stats
+
+    args.approve = args.approve or ["socket"]
+    # Only a client with the token of this session gets the questions
+    args.token = newtoken()
+    if "socket" in args.approve:
+        print(f"The token for manualbox-approve is: {args.token}")
+    approvers = [APPROVERS[name](broker, args) for name in args.approve]
+    for approver in approvers:
+        approver.start()
+    try:
+        mount(fs, args.mountpath, profile=args.profile, nothreads=args.nothreads)
+    finally:
+        for approver in approvers:
+            approver.stop()
+        try:
+            fs.saveondisk()
+        finally:
+            fs.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
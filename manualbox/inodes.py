@@ -0,0 +1,222 @@
+import os
+from array import array
+from stat import S_IFDIR, S_ISDIR
+from time import time
+
+# The inode number of the root directory, 0 is never used
+ROOT = 1
+
+# The stat fields of an inode, in the order they are saved
+FIELDS = ("mode", "nlink", "uid", "gid", "size", "atime", "mtime", "ctime")
+
+
+class InodeTable:
+    """
+    Metadata of every file, directory and symlink, and the tree of names.
+
+    Every stat field is an array indexed by the inode number, so an inode
+    costs a few machine words and no Python objects. The stat dictionary FUSE
+    wants is only built when getattr asks for it. Extended attributes are in
+    a dictionary, only for the inodes which have any.
+
+    Every directory has a dictionary from the names inside of it to their
+    inode numbers, and a path is looked up one name at a time from ROOT. So
+    renaming a directory only moves one name, whatever is inside of it.
+
+    A free inode has a mode of 0, and its number gets used again. The contents
+    of the files are kept by inode number outside of the table, so they do not
+    move when a path gets renamed.
+    """
+
+    def __init__(self):
+        # 32 bits are enough for everything but the size and the times
+        self.mode = array("I", [0])
+        self.nlink = array("I", [0])
+        self.uid = array("I", [0])
+        self.gid = array("I", [0])
+        self.size = array("q", [0])
+        self.atime = array("d", [0])
+        self.mtime = array("d", [0])
+        self.ctime = array("d", [0])
+        self.attrs = {}
+        self.entries = {}
+        self.free = []
+
+    def __contains__(self, path):
+        return self.lookup(path) is not None
+
+    def __len__(self):
+        return len(self.mode) - 1 - len(self.free)
+
+    def columns(self):
+        return [getattr(self, name) for name in FIELDS]
+
+    def lookup(self, path):
+        "Returns the inode number of path, or None"
+        entries = self.entries
+        ino = ROOT
+        for name in path.split("/"):
+            if name:
+                try:
+                    ino = entries[ino][name]
+                except KeyError:
+                    return None
+        return ino
+
+    def split(self, path):
+        "Returns the inode number of the parent of path, or None, and the name"
+        parent, name = path.rsplit("/", 1)
+        return self.lookup(parent), name
+
+    def isdir(self, ino):
+        return S_ISDIR(self.mode[ino])
+
+    def new(self, mode, nlink=1, size=0):
+        "Creates a new inode and returns its number, it still needs a link"
+        ino = self.free.pop() if self.free else len(self.mode)
+        now = time()
+        self.setrecord(
+            ino, (mode, nlink, os.getuid(), os.getgid(), size, now, now, now)
+        )
+        return ino
+
+    def root(self):
+        "Creates the root directory of an empty filesystem"
+        return self.new(S_IFDIR | 0o755, nlink=2)
+
+    def link(self, parent, name, ino):
+        "Adds name for the inode inside of the directory parent"
+        self.entries[parent][name] = ino
+
+    def unlink(self, parent, name):
+        "Removes name from the directory parent, and returns its inode number"
+        return self.entries[parent].pop(name)
+
+    def remove(self, ino):
+        "Frees the inode, the names pointing to it have to be removed first"
+        self.mode[ino] = 0
+        self.attrs.pop(ino, None)
+        self.entries.pop(ino, None)
+        self.free.append(ino)
+
+    def stat(self, ino, allocated=0):
+        "Returns the stat dictionary, allocated is the number of bytes in use"
+        return dict(
+            st_ino=ino,
+            st_mode=self.mode[ino],
+            st_nlink=self.nlink[ino],
+            st_uid=self.uid[ino],
+            st_gid=self.gid[ino],
+            st_size=self.size[ino],
+            st_atime=self.atime[ino],
+            st_mtime=self.mtime[ino],
+            st_ctime=self.ctime[ino],
+            # Counted in 512 byte units, whatever the block size is
+            st_blocks=(allocated + 511) // 512,
+        )
+
+    def record(self, ino):
+        "Returns the stat fields and the attributes of the inode, None if it is free"
+        if not self.mode[ino]:
+            return None
+        attrs = self.attrs.get(ino)
+        return tuple(column[ino] for column in self.columns()) + (
+            dict(attrs) if attrs else None,
+        )
+
+    def setrecord(self, ino, record):
+        "Sets the inode from a record, the table grows as required"
+        columns = self.columns()
+        while len(self.mode) <= ino:
+            for column in columns:
+                column.append(0)
+        for column, value in zip(columns, record):
+            column[ino] = value
+        if len(record) > len(FIELDS) and record[len(FIELDS)]:
+            self.attrs[ino] = record[len(FIELDS)]
+        else:
+            self.attrs.pop(ino, None)
+        if S_ISDIR(self.mode[ino]):
+            self.entries.setdefault(ino, {})
+        else:
+            self.entries.pop(ino, None)
+
+    def dump(self):
+        "Returns the whole table as values which can be pickled"
+        attrs = {ino: dict(value) for ino, value in self.attrs.items()}
+        entries = {ino: dict(names) for ino, names in self.entries.items()}
+        return [column[:] for column in self.columns()], attrs, entries
+
+    def changes(self, names, inos):
+        """
+        Returns the update for the given (directory, name) pairs and inode
+        numbers, see apply
+        """
+        return (
+            {ino: self.record(ino) for ino in inos},
+            {
+                (parent, name): self.entries.get(parent, {}).get(name)
+                for parent, name in names
+            },
+        )
+
+    def apply(self, update):
+        "Applies an update from changes, a None value removes the entry"
+        records, names = update
+        for ino, record in records.items():
+            if record is None:
+                if ino < len(self.mode):
+                    self.mode[ino] = 0
+                    self.attrs.pop(ino, None)
+                    self.entries.pop(ino, None)
+            else:
+                self.setrecord(ino, record)
+        for (parent, name), ino in names.items():
+            if ino is None:
+                self.entries.get(parent, {}).pop(name, None)
+            elif parent in self.entries:
+                self.entries[parent][name] = ino
+
+    @classmethod
+    def load(cls, state, updates=()):
+        "Creates the table from the values returned by dump and the later updates"
+        table = cls()
+        columns, table.attrs, table.entries = state
+        for name, column in zip(FIELDS, columns):
+            setattr(table, name, column)
+        for update in updates:
+            table.apply(update)
+        table.free = [ino for ino in range(1, len(table.mode)) if not table.mode[ino]]
+        return table
+
+    @classmethod
+    def from_legacy(cls, files):
+        "Converts the stat dictionaries by path from an older storage"
+        table = cls()
+        # The parents come before what is inside of them, the root first
+        for path in sorted(files, key=lambda path: (path != "/", path.count("/"))):
+            stat = files[path]
+            if path == "/":
+                parent = None
+            else:
+                parent, name = table.split(path)
+                if parent is None or not table.isdir(parent):
+                    continue
+            ino = len(table.mode)
+            table.setrecord(
+                ino,
+                (
+                    stat["st_mode"],
+                    stat.get("st_nlink", 1),
+                    stat.get("st_uid", os.getuid()),
+                    stat.get("st_gid", os.getgid()),
+                    stat.get("st_size", 0),
+                    stat.get("st_atime", 0),
+                    stat.get("st_mtime", 0),
+                    stat.get("st_ctime", 0),
+                    stat.get("attrs"),
+                ),
+            )
+            if parent is not None:
+                table.link(parent, name, ino)
+        return table
@@ -12,6 +12,13 @@ from .utils import get_asset_path
 
 
 class MainInput(QtWidgets.QDialog):
+    """
+    Asks the user to allow or deny one access. The dialog is built once and
+    shown again with setrequest for every question, the answer is emitted
+    with answered.
+    """
+
+    answered = pyqtSignal(str)
     CSS = """
             QLabel#filepath {
                 color: black;
@@ -52,17 +59,14 @@ class MainInput(QtWidgets.QDialog):
         iconlayoutWidget.setLayout(iconlayout)
 
         self.layout.addWidget(iconlayoutWidget)
-        if process_name:
-            process_txt = f'The process <span style="color:#aa0000">{process_name}</span> is asking to access:'
-            process_label = QLabel()
-            process_label.setTextFormat(Qt.RichText)
-            process_label.setText(process_txt)
-            process_label.setObjectName("processname")
-            self.layout.addWidget(process_label)
-
-        label = QLabel(display_path)
-        label.setObjectName("filepath")
-        self.layout.addWidget(label)
+        self.process_label = QLabel()
+        self.process_label.setTextFormat(Qt.RichText)
+        self.process_label.setObjectName("processname")
+        self.layout.addWidget(self.process_label)
+
+        self.path_label = QLabel()
+        self.path_label.setObjectName("filepath")
+        self.layout.addWidget(self.path_label)
         self.buttonLayout = QHBoxLayout()
         self.okay = QPushButton(QIcon(QPixmap(get_asset_path("check.png"))), "Allow")
         self.cancel = QPushButton(QIcon(QPixmap(get_asset_path("cross.png"))), "Deny")
@@ -82,19 +86,33 @@ class MainInput(QtWidgets.QDialog):
         # self.setWindowFlags(Qt.FramelessWindowHint)
         screen_size = QDesktopWidget().screenGeometry()
         window_size = self.geometry()
-        x_center = (screen_size.width() - window_size.width()) / 2
-        y_center = (screen_size.height() - window_size.height()) / 2
+        x_center = (screen_size.width() - window_size.width()) // 2
+        y_center = (screen_size.height() - window_size.height()) // 2
         self.move(x_center, y_center)
         self.setWindowTitle("Will you allow access of the following file?")
+        self.setrequest(display_path, process_name)
+
+    def setrequest(self, display_path, process_name):
+        "Sets the file and the process to ask about"
+        process_txt = f'The process <span style="color:#aa0000">{process_name}</span> is asking to access:'
+        self.process_label.setText(process_txt)
+        self.process_label.setVisible(bool(process_name))
+        self.path_label.setText(display_path)
         self.userstatus = ""
 
     def okayCalled(self):
         self.userstatus = "okay"
         self.hide()
+        self.answered.emit(self.userstatus)
 
     def cancelCalled(self):
         self.userstatus = "nope"
         self.hide()
+        self.answered.emit(self.userstatus)
+
+    def reject(self):
+        "Esc and the close button of the window deny the access"
+        self.cancelCalled()
 
 
 def main(display_path="", process_name=""):
@@ -102,9 +120,8 @@ def main(display_path="", process_name=""):
     form.show()
     form.setWindowState(Qt.WindowState.WindowActive)
     form.raise_()
+    # This returns once the dialog is hidden by one of the buttons
     form.exec()
-    while not form.isHidden():
-        pass
     return form.userstatus
 
 
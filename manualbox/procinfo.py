@@ -0,0 +1,171 @@
+import os
+import resource
+import select
+import threading
+from collections import OrderedDict, namedtuple
+from errno import EINVAL, EMFILE, ENFILE, ENOENT
+
+# A process is the pid together with its start time, so that a new process
+# which gets an old pid is never mistaken for the old one.
+ProcessIdentity = namedtuple("ProcessIdentity", ["pid", "started"])
+
+# Opens the pidfd of a thread which is not the main thread of its process,
+# since Linux 6.9
+PIDFD_THREAD = os.O_EXCL
+
+
+def pidfd_open(pid):
+    """
+    Returns a pidfd for pid, or None where the kernel can not watch it.
+
+    FUSE gives the id of the calling thread, and for any thread but the main
+    one pidfd_open fails with EINVAL (ENOENT since 6.9) unless PIDFD_THREAD
+    is given, which older kernels do not know.
+    """
+    try:
+        return os.pidfd_open(pid)
+    except OSError as err:
+        if err.errno not in (EINVAL, ENOENT):
+            raise
+    try:
+        return os.pidfd_open(pid, PIDFD_THREAD)
+    except OSError as err:
+        if err.errno != EINVAL:
+            raise
+    return None
+
+
+class ProcessEntry:
+    __slots__ = ("identity", "pidfd", "name")
+
+    def __init__(self, identity, pidfd):
+        self.identity = identity
+        self.pidfd = pidfd
+        self.name = None
+
+
+class ProcessCache:
+    """
+    Caches the identity of the processes which talk to the filesystem.
+
+    Where the platform has pidfd_open (Linux 5.3+), we keep a pidfd for every
+    cached process. A pidfd turns readable when its process exits, so checking
+    that a cached pid still belongs to the same process is one poll call, and
+    does not touch /proc. Elsewhere, and for a thread the kernel can not give
+    a pidfd for, the start time gets read again on every lookup. The name of a
+    process is only looked up when somebody asks for it.
+
+    Every pidfd is an open file, so at most a quarter of the open files the
+    process may have are cached, and the entries of the processes which
+    exited are dropped first once the cache is full.
+    """
+
+    def __init__(self, maxsize=256):
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.usepidfd = hasattr(os, "pidfd_open")
+        self.maxsize = maxsize
+        if self.usepidfd:
+            limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+            if limit != resource.RLIM_INFINITY:
+                self.maxsize = max(min(maxsize, limit // 4), 1)
+
+    def identity(self, pid):
+        "Returns the ProcessIdentity of pid, or None if the process is gone"
+        with self.lock:
+            entry = self.entries.get(pid)
+            if entry is not None:
+                if self.alive(entry):
+                    self.entries.move_to_end(pid)
+                    return entry.identity
+                del self.entries[pid]
+                self.release(entry)
+        entry = self.lookup(pid)
+        if entry is None:
+            return None
+        with self.lock:
+            old = self.entries.pop(pid, None)
+            if old is not None:
+                self.release(old)
+            if len(self.entries) >= self.maxsize:
+                self.dropexited()
+            self.entries[pid] = entry
+            while len(self.entries) > self.maxsize:
+                self.release(self.entries.popitem(last=False)[1])
+        return entry.identity
+
+    def dropexited(self):
+        "Drops the entries of the processes which exited, with the lock held"
+        poller = select.poll()
+        pids = {}
+        for pid, entry in self.entries.items():
+            if entry.pidfd is not None:
+                poller.register(entry.pidfd, select.POLLIN)
+                pids[entry.pidfd] = pid
+        for fd, _ in poller.poll(0):
+            self.release(self.entries.pop(pids[fd]))
+
+    def name(self, identity):
+        "Returns the name of the process, or an empty string if it is gone"
+        with self.lock:
+            entry = self.entries.get(identity.pid)
+        if entry is None or entry.identity != identity:
+            return ""
+        if entry.name is None:
+            import psutil
+
+            try:
+                entry.name = psutil.Process(pid=identity.pid).name()
+            except psutil.Error:
+                return ""
+        return entry.name
+
+    def alive(self, entry):
+        "Tells if the cached entry still belongs to a running process"
+        if entry.pidfd is None:
+            import psutil
+
+            try:
+                started = psutil.Process(pid=entry.identity.pid).create_time()
+            except psutil.Error:
+                return False
+            return started == entry.identity.started
+        poller = select.poll()
+        poller.register(entry.pidfd, select.POLLIN)
+        return not poller.poll(0)
+
+    def lookup(self, pid):
+        "Reads the identity of pid from the system"
+        pidfd = None
+        if self.usepidfd:
+            # Open the pidfd first, so the start time belongs to the same process
+            try:
+                pidfd = pidfd_open(pid)
+            except ProcessLookupError:
+                return None
+            except OSError as err:
+                # Out of files only this entry goes without a pidfd, but for
+                # anything else, like ENOSYS or a seccomp filter, all of them
+                if err.errno not in (EMFILE, ENFILE):
+                    self.usepidfd = False
+        # psutil takes a while to import, so this waits till a process asks
+        import psutil
+
+        try:
+            started = psutil.Process(pid=pid).create_time()
+        except psutil.Error:
+            if pidfd is not None:
+                os.close(pidfd)
+            return None
+        return ProcessEntry(ProcessIdentity(pid, started), pidfd)
+
+    def release(self, entry):
+        if entry.pidfd is not None:
+            os.close(entry.pidfd)
+            entry.pidfd = None
+
+    def clear(self):
+        with self.lock:
+            for entry in self.entries.values():
+                self.release(entry)
+            self.entries.clear()
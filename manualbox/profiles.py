@@ -0,0 +1,58 @@
+from .fuseapi import FUSE
+from .stats import isvirtual
+
+# FUSE mount options by profile name. Every change goes through this mount,
+# so the kernel knows when the metadata it cached is stale, and long timeouts
+# are safe. None of them uses kernel_cache, which would hand the cached pages
+# of a file to any process without asking the user, see ManualBoxFUSE.
+PROFILES = {
+    # What FUSE does without options, the metadata is cached for a second
+    "default": {},
+    # The metadata and the lookups are cached for a minute
+    "cached": {
+        "attr_timeout": 60,
+        "entry_timeout": 60,
+        "negative_timeout": 10,
+    },
+    # Also as large reads and writes as FUSE 2 allows, instead of 4 KiB writes
+    "streaming": {
+        "attr_timeout": 60,
+        "entry_timeout": 60,
+        "negative_timeout": 10,
+        "max_read": 128 * 1024,
+        "max_write": 128 * 1024,
+        "big_writes": True,
+    },
+}
+
+
+class ManualBoxFUSE(FUSE):
+    """
+    Sets the caching of every opened file.
+
+    The kernel keeps the cached pages of a file over an open only for a
+    process which the user already allowed to read it. Any other open drops
+    them, so that the reads come to the filesystem and the user gets asked.
+    The statistics are never cached, every open reads new numbers.
+    """
+
+    def open(self, path, fip):
+        result = super().open(path, fip)
+        fi = fip.contents
+        if isvirtual(path.decode(self.encoding)):
+            fi.direct_io = 1
+        else:
+            fi.keep_cache = int(self.operations.keepcache(fi.fh))
+        return result
+
+
+def mount(fs, mountpath, profile="default", nothreads=False):
+    "Mounts fs at mountpath with the options of the profile, returns once unmounted"
+    return ManualBoxFUSE(
+        fs,
+        mountpath,
+        foreground=True,
+        nothreads=nothreads,
+        allow_other=False,
+        **PROFILES[profile],
+    )
@@ -0,0 +1,187 @@
+import json
+import os
+import stat
+import threading
+from contextlib import contextmanager
+from errno import ENOENT, EROFS
+from time import perf_counter, time
+
+from .fuseapi import FuseOSError
+
+# The statistics are readable from this directory inside of the mount
+STATS_DIR = "/.manualbox"
+STATS_PATH = STATS_DIR + "/stats"
+
+# The only operations allowed on the files inside of STATS_DIR
+READONLY = {
+    "access",
+    "flush",
+    "getattr",
+    "getxattr",
+    "listxattr",
+    "open",
+    "opendir",
+    "read",
+    "readdir",
+    "release",
+    "releasedir",
+    "statfs",
+}
+
+# Latency buckets are powers of two in microseconds, the last one holds the rest
+BUCKETS = 32
+
+
+def isvirtual(path):
+    return path == STATS_DIR or path.startswith(STATS_DIR + "/")
+
+
+class OperationStats:
+    __slots__ = ("calls", "errors", "bytes", "seconds", "histogram")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.histogram = [0] * BUCKETS
+
+    def report(self):
+        histogram = {}
+        for bucket, count in enumerate(self.histogram):
+            if count:
+                label = f"<{2 ** bucket}us" if bucket < BUCKETS - 1 else "rest"
+                histogram[label] = count
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "bytes": self.bytes,
+            "seconds": round(self.seconds, 6),
+            "mean_us": round(self.seconds / self.calls * 1e6, 1) if self.calls else 0,
+            "latency": histogram,
+        }
+
+
+class Stats:
+    """
+    Call counts, bytes moved and latency histograms for every operation.
+
+    Other parts of the filesystem can add their own counters to the report by
+    putting a function returning a dictionary into sources.
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.sources = {}
+        self.started = time()
+        self.lock = threading.Lock()
+
+    def record(self, op, seconds, nbytes=0, error=False):
+        bucket = min(int(seconds * 1e6).bit_length(), BUCKETS - 1)
+        with self.lock:
+            stats = self.operations.get(op)
+            if stats is None:
+                stats = self.operations[op] = OperationStats()
+            stats.calls += 1
+            stats.bytes += nbytes
+            stats.seconds += seconds
+            stats.histogram[bucket] += 1
+            if error:
+                stats.errors += 1
+
+    @contextmanager
+    def timed(self, op):
+        "Records the time spent inside of the with block as op"
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(op, perf_counter() - start)
+
+    def report(self):
+        with self.lock:
+            operations = {op: stats.report() for op, stats in self.operations.items()}
+        result = {"uptime": round(time() - self.started, 3), "operations": operations}
+        for name, source in self.sources.items():
+            result[name] = source()
+        return result
+
+    def render(self):
+        return (json.dumps(self.report(), indent=2, sort_keys=True) + "\n").encode(
+            "utf-8"
+        )
+
+
+class StatsMixIn:
+    """
+    Measures every FUSE operation into self.stats, and serves the read-only
+    STATS_PATH file without asking the user. This takes the place of the
+    LoggingMixIn from fusepy.
+    """
+
+    statscontent = b""
+
+    def __call__(self, op, path, *args):
+        if isvirtual(path) or (op == "rename" and isvirtual(args[0])):
+            return self.virtual(op, path, *args)
+        start = perf_counter()
+        error = False
+        result = None
+        try:
+            result = super().__call__(op, path, *args)
+            return result
+        except BaseException:
+            error = True
+            raise
+        finally:
+            nbytes = 0
+            if op == "read" and result:
+                nbytes = len(result)
+            elif op == "write" and not error:
+                nbytes = result
+            self.stats.record(op, perf_counter() - start, nbytes, error)
+
+    def virtual(self, op, path, *args):
+        "Handles the operations on STATS_DIR and the files inside"
+        if op not in READONLY:
+            raise FuseOSError(EROFS)
+        if path not in (STATS_DIR, STATS_PATH):
+            raise FuseOSError(ENOENT)
+        if op == "getattr":
+            return self.virtualattr(path)
+        if op == "readdir":
+            return [".", "..", os.path.basename(STATS_PATH)]
+        if op == "open" and path == STATS_PATH:
+            # The kernel may have cached the attributes, so take new numbers here too
+            self.statscontent = self.stats.render()
+        if op == "read":
+            size, offset = args[0], args[1]
+            return self.statscontent[offset : offset + size]
+        if op == "getxattr":
+            return ""
+        if op == "listxattr":
+            return []
+        if op == "statfs":
+            return super().__call__(op, "/", *args)
+        return 0
+
+    def virtualattr(self, path):
+        now = time()
+        attrs = dict(
+            st_ctime=self.stats.started,
+            st_mtime=now,
+            st_atime=now,
+            st_uid=os.getuid(),
+            st_gid=os.getgid(),
+        )
+        if path == STATS_DIR:
+            attrs.update(st_mode=(stat.S_IFDIR | 0o555), st_nlink=2, st_size=0)
+        else:
+            # The content is taken here, so that the size matches what gets read
+            self.statscontent = self.stats.render()
+            attrs.update(
+                st_mode=(stat.S_IFREG | 0o444),
+                st_nlink=1,
+                st_size=len(self.statscontent),
+            )
+        return attrs
@@ -0,0 +1,633 @@
+import fcntl
+import os
+import pickle
+import struct
+import threading
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from cryptography.fernet import Fernet, InvalidToken
+
+from .blockcache import CACHE_SIZE, BlockCache
+from .chunks import ChunkedFile
+from .compression import Compressor
+from .crypto import KEYHEADER, KeyHeader, SegmentCipher
+
+# Every base storage file in this format starts with the magic, the version
+# and the KeyHeader, and ends with a trailer pointing to the encrypted index.
+# Older storage files are a single Fernet token, which always starts with
+# "gAAAAA".
+MAGIC = b"MANUALBX"
+VERSION = 7
+HEADER = MAGIC + struct.pack(">B", VERSION)
+TRAILER = struct.Struct(">QQ8s")
+
+# The journal starts with its own magic, the version and the generation of the
+# base file it belongs to, followed by records. Each record is a kind and a
+# length in plain text, and then the encrypted body.
+JOURNAL_MAGIC = b"MANUALBJ"
+JOURNAL_HEADER = JOURNAL_MAGIC + struct.pack(">B", VERSION)
+GENERATION_SIZE = 16
+RECORD = struct.Struct(">BQ")
+
+# The kinds of encrypted segments, the kind is authenticated with the segment
+CHUNK, COMMIT, INDEX = 1, 2, 3
+
+# The journal gets folded into a new base file once it grows past both of these
+COMPACT_MIN_SIZE = 16 * 1024 * 1024
+COMPACT_RATIO = 0.5
+
+# Blocks in flight for every worker, while saving or reading many blocks
+WORKER_QUEUE = 4
+
+# The file in which a stored block lives, as written in the index and commits
+BASE, JOURNAL = 0, 1
+
+# Where an encrypted block lives inside the storage
+StoredChunk = namedtuple("StoredChunk", ["segment", "offset", "length"])
+
+
+class StorageInUse(OSError):
+    "Another VaultStore, in this process or another one, has the storage open"
+
+
+def fsync_directory(path):
+    "Makes sure a rename or a new file inside the directory of path reached the disk"
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class VaultStore:
+    """
+    Encrypted storage of the filesystem on disk.
+
+    The store does not look into the metadata of the filesystem, it saves what
+    it is given and hands the same back on load. File contents are kept by an
+    id, which is the inode number.
+
+    Each block of each file is encrypted on its own, and an encrypted index at
+    the end of the base file holds the metadata, the digests of the blocks of
+    every file and where the block of every digest is. Loading only decrypts
+    the index, blocks are decrypted when they are read, and at most
+    cache_size bytes of them are kept, see BlockCache.
+
+    A block is stored once however many files have it. The files reference
+    blocks by digest, and a digest is dropped together with its decrypted
+    block once no file references it any more. The space on disk comes back
+    with the next compaction.
+
+    Saving appends only the changed blocks and metadata to a journal next to
+    the base file. Once the journal grows too large, everything is compacted
+    into a new base file, which atomically replaces the old one.
+
+    All the writing is streamed one block at a time, so saving does not need
+    more memory as the vault grows. The blocks are digested, compressed,
+    encrypted and decrypted on worker threads, as zlib, BLAKE2b and AES-GCM
+    let go of the GIL, and still written one after another.
+
+    Saving works on a snapshot, see ChunkedFile.snapshot, and returns the
+    digests of the dirty blocks. The caller has to hold the store from taking
+    the snapshot till it has recorded the digests, and then call release.
+    While the store is held no digest is dropped, and the blocks of a replaced
+    base file stay readable.
+    """
+
+    def __init__(
+        self,
+        path,
+        key,
+        compression="zlib",
+        passphrase_cost=None,
+        workers=None,
+        cache_size=CACHE_SIZE,
+    ):
+        self.path = path
+        self.journalpath = path + ".journal"
+        # Only one store at a time may have the storage, or the saves of one
+        # would throw away the journal records of the other. The base file
+        # gets replaced by every compaction, so the lock is on a file next
+        # to it, and it is held till close.
+        self.lockfile = open(path + ".lock", "ab")
+        try:
+            fcntl.flock(self.lockfile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self.lockfile.close()
+            raise StorageInUse(f"{path} is in use by another ManualBox")
+        # Fernet is only used to read the older format
+        # Only set for a storage in the older format
+        self.locker = None
+        try:
+            self.keyheader, secret = self.unlock(key, passphrase_cost)
+        except BaseException:
+            self.lockfile.close()
+            raise
+        self.cipher = SegmentCipher(secret, HEADER)
+        # Every segment gets compressed before it is encrypted, if that helps
+        self.compressor = Compressor(compression)
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None
+        if self.workers > 1:
+            self.pool = ThreadPoolExecutor(
+                self.workers, thread_name_prefix="manualbox-store"
+            )
+        self.segments = {}
+        self.nextsegment = 0
+        self.baseid = None
+        self.journalid = None
+        # Segments which are not used after the last save
+        self.retired = []
+        # Random id of the current base file, None till there is one
+        self.generation = None
+        # Where the last complete journal record ends
+        self.journal_end = 0
+        # True when the storage on disk was in the older format
+        self.legacy = False
+        # Where the block of every digest is, how many references it has, and
+        # the blocks which were decrypted or saved
+        self.chunks = {}
+        self.refs = {}
+        self.cache = BlockCache(cache_size)
+        # Digests which might have lost their references while the store was held
+        self.garbage = set()
+        self.holds = 0
+        self.deduplicated = 0
+        self.lock = threading.Lock()
+
+    def unlock(self, key, passphrase_cost):
+        """
+        Returns the KeyHeader and the secret of the storage. Only the header
+        of an existing storage is read, and InvalidToken is raised if key is
+        not the right one.
+
+        A new storage uses key as a Fernet key, or as a passphrase if a
+        passphrase_cost is given, see KeyHeader.new.
+        """
+        try:
+            with open(self.path, "rb") as fobj:
+                header = fobj.read(len(HEADER) + KEYHEADER.size)
+        except FileNotFoundError:
+            header = b""
+        if header.startswith(MAGIC):
+            if not header.startswith(HEADER):
+                raise ValueError(f"{self.path} is from an unknown ManualBox version")
+            if len(header) < len(HEADER) + KEYHEADER.size:
+                raise ValueError(f"{self.path} is not a complete ManualBox storage")
+            keyheader = KeyHeader.unpack(header[len(HEADER) :])
+            return keyheader, keyheader.unlock(key)
+        if header:
+            self.locker = Fernet(key)
+        return KeyHeader.new(key, passphrase_cost)
+
+    def opensegment(self, path):
+        "Opens path for reading and returns its segment id"
+        segment = self.nextsegment
+        self.nextsegment += 1
+        self.segments[segment] = open(path, "rb")
+        return segment
+
+    def load(self):
+        """
+        Returns (metadata, data, updates) from the disk, or None if there is no
+        storage yet. metadata is what was last given to compact, and updates
+        are the ones given to append after that, in order. data has the
+        contents of every id with all the updates applied. The file blocks are
+        loaded lazily with block.
+
+        For the older format, legacy is set and metadata is the stat
+        dictionaries by path, with the contents also by path.
+        """
+        if not os.path.exists(self.path):
+            return None
+        self.reset()
+        self.baseid = self.opensegment(self.path)
+        fobj = self.segments[self.baseid]
+        header = fobj.read(len(HEADER))
+        if not header.startswith(MAGIC):
+            return self.load_legacy()
+        if header != HEADER:
+            raise ValueError(f"{self.path} is from an unknown ManualBox version")
+
+        fobj.seek(-TRAILER.size, os.SEEK_END)
+        index_offset, index_length, magic = TRAILER.unpack(fobj.read())
+        if magic != MAGIC:
+            raise ValueError(f"{self.path} is not a complete ManualBox storage")
+        self.generation, metadata, index, chunks = pickle.loads(
+            self.read_chunk(StoredChunk(self.baseid, index_offset, index_length), INDEX)
+        )
+        self.chunks = {digest: self.location(value) for digest, value in chunks.items()}
+        data = defaultdict(ChunkedFile)
+        for ident, (size, stored) in index.items():
+            data[ident] = self.chunked(size, stored)
+        # A block dropped by one commit can be used again by a later one
+        self.hold()
+        try:
+            updates = self.replay(data)
+        finally:
+            self.release()
+        return metadata, data, updates
+
+    def load_legacy(self):
+        "Reads the older format, where everything is one encrypted pickle"
+        fobj = self.segments[self.baseid]
+        fobj.seek(0)
+        files, olddata = pickle.loads(self.locker.decrypt(fobj.read()))
+        self.reset()
+        self.legacy = True
+        data = defaultdict(ChunkedFile)
+        for path, value in olddata.items():
+            data[path] = ChunkedFile.from_legacy(value)
+        return files, data, []
+
+    def chunked(self, size, stored):
+        "Creates a ChunkedFile with all of its blocks still on disk"
+        chunked = ChunkedFile()
+        chunked.store = self
+        chunked.size = size
+        chunked.stored = dict(stored)
+        for digest in stored.values():
+            self.ref(digest)
+        return chunked
+
+    def location(self, value):
+        "Converts a (file, offset, length) from the disk to a StoredChunk"
+        where, offset, length = value
+        return StoredChunk(
+            self.baseid if where == BASE else self.journalid, offset, length
+        )
+
+    def ondisk(self, chunk):
+        "Converts a StoredChunk to (file, offset, length) for the disk"
+        where = BASE if chunk.segment == self.baseid else JOURNAL
+        return where, chunk.offset, chunk.length
+
+    def replay(self, data):
+        """
+        Applies the contents from every complete commit in the journal on top
+        of the base, and returns the metadata updates of the commits. A torn
+        record at the end, from a crash in the middle of a save, is ignored.
+        """
+        self.journal_end = 0
+        updates = []
+        if not os.path.exists(self.journalpath):
+            return updates
+        self.journalid = self.opensegment(self.journalpath)
+        fobj = self.segments[self.journalid]
+        if fobj.read(len(JOURNAL_HEADER) + GENERATION_SIZE) != (
+            JOURNAL_HEADER + self.generation
+        ):
+            # This journal was already compacted into the base
+            fobj.close()
+            del self.segments[self.journalid]
+            self.journalid = None
+            return updates
+        self.journal_end = fobj.tell()
+        filesize = os.fstat(fobj.fileno()).st_size
+        while True:
+            header = fobj.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            kind, length = RECORD.unpack(header)
+            offset = fobj.tell()
+            if kind not in (CHUNK, COMMIT) or offset + length > filesize:
+                break
+            if kind == CHUNK:
+                fobj.seek(length, os.SEEK_CUR)
+                continue
+            body = fobj.read(length)
+            try:
+                commit = pickle.loads(self.unseal(body, COMMIT))
+            except InvalidToken:
+                break
+            update, contents, chunks = commit
+            for digest, value in chunks.items():
+                self.chunks[digest] = self.location(value)
+            for ident, stored in contents.items():
+                old = data.pop(ident, None)
+                if stored is not None:
+                    data[ident] = self.chunked(*stored)
+                if old is not None:
+                    old.drop()
+            updates.append(update)
+            self.journal_end = offset + length
+        return updates
+
+    def read_raw(self, chunk):
+        "Returns the encrypted bytes of the given chunk, safe to call from many threads"
+        fobj = self.segments[chunk.segment]
+        return os.pread(fobj.fileno(), chunk.length, chunk.offset)
+
+    def read_chunk(self, chunk, kind=CHUNK):
+        "Returns the decrypted bytes of the given chunk"
+        return self.unseal(self.read_raw(chunk), kind)
+
+    def block(self, digest):
+        "Returns the decrypted block of the digest, it is decrypted only once"
+        with self.lock:
+            block = self.cache.get(digest)
+            if block is not None:
+                return block
+            # Read under the lock, so that a compaction cannot close the file
+            encrypted = self.read_raw(self.chunks[digest])
+        block = self.unseal(encrypted, CHUNK)
+        with self.lock:
+            if digest in self.refs:
+                block = self.cache.put(digest, block)
+        return block
+
+    def prefetch(self, digests):
+        "Decrypts the blocks of the digests which are not decrypted yet, on the workers"
+        if self.pool is None:
+            return
+        with self.lock:
+            missing = []
+            # Only about half of the cache, so that the blocks are still there
+            # when they are read
+            room = self.cache.maxbytes // 2
+            for digest in dict.fromkeys(digests):
+                if digest in self.cache or digest not in self.chunks:
+                    continue
+                room -= self.chunks[digest].length
+                if room < 0:
+                    break
+                missing.append(digest)
+            if len(missing) < 2:
+                return
+            encrypted = [self.read_raw(self.chunks[digest]) for digest in missing]
+        blocks = self.parallel(lambda token: self.unseal(token, CHUNK), encrypted)
+        for digest, block in zip(missing, blocks):
+            with self.lock:
+                if digest in self.refs:
+                    self.cache.put(digest, block)
+
+    def parallel(self, func, items):
+        """
+        Yields func(item) for every item in order, computed on the workers. Only
+        WORKER_QUEUE items for every worker are in flight, so the memory used
+        does not grow with the number of items.
+        """
+        if self.pool is None:
+            yield from map(func, items)
+            return
+        pending = deque()
+        for item in items:
+            pending.append(self.pool.submit(func, item))
+            if len(pending) >= self.workers * WORKER_QUEUE:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def digests(self, data):
+        "Returns the digests of the dirty blocks by id and block index"
+        keys = [
+            (ident, key) for ident, chunked in data.items() for key in chunked.dirty
+        ]
+        blocks = (data[ident].blocks[key] for ident, key in keys)
+        digests = defaultdict(dict)
+        for (ident, key), digest in zip(
+            keys, self.parallel(self.cipher.digest, blocks)
+        ):
+            digests[ident][key] = digest
+        return digests
+
+    def ref(self, digest, block=None):
+        "Adds a reference to the digest, block is its content if it is at hand"
+        with self.lock:
+            self.refs[digest] = self.refs.get(digest, 0) + 1
+            if block is not None:
+                self.cache.put(digest, block)
+
+    def unref(self, digest):
+        with self.lock:
+            count = self.refs[digest] - 1
+            if count:
+                self.refs[digest] = count
+                return
+            del self.refs[digest]
+            if self.holds:
+                self.garbage.add(digest)
+            else:
+                self.chunks.pop(digest, None)
+                self.cache.pop(digest)
+
+    def hold(self):
+        "Keeps every digest till release, see the class documentation"
+        with self.lock:
+            self.holds += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "blocks": len(self.chunks),
+                "references": sum(self.refs.values()),
+                **self.cache.stats(),
+                "deduplicated": self.deduplicated,
+                "workers": self.workers,
+            }
+
+    def seal(self, data, kind):
+        "Compresses and encrypts data"
+        return self.cipher.encrypt(self.compressor.pack(data), kind)
+
+    def sealblock(self, block):
+        return self.seal(block, CHUNK)
+
+    def unseal(self, token, kind):
+        "Decrypts and decompresses what seal returned"
+        return self.compressor.unpack(self.cipher.decrypt(token, kind))
+
+    def needscompaction(self):
+        "Tells if the next save has to write a new base file"
+        return self.generation is None or self.journal_end > max(
+            COMPACT_MIN_SIZE, os.path.getsize(self.path) * COMPACT_RATIO
+        )
+
+    def append(self, update, data, changed):
+        """
+        Appends the dirty blocks of the changed ids and a commit record with
+        the metadata update. data only needs to have the changed ids, an id
+        which is not in there gets removed. A block which is stored already is
+        not written again. Returns the digests of the dirty blocks for every
+        id in data.
+        """
+        saved = {}
+        if self.journalid is None:
+            with open(self.journalpath, "wb") as fobj:
+                fobj.write(JOURNAL_HEADER + self.generation)
+                fobj.flush()
+                os.fsync(fobj.fileno())
+            # Without this a crash can lose the new journal with its commits
+            fsync_directory(self.journalpath)
+            self.journalid = self.opensegment(self.journalpath)
+            self.journal_end = len(JOURNAL_HEADER) + GENERATION_SIZE
+
+        contents = {}
+        written = {}
+        alldigests = self.digests(
+            {ident: data[ident] for ident in changed if ident in data}
+        )
+        # The blocks which are not stored yet, each once
+        blocks = {}
+        for ident in changed:
+            if ident not in data:
+                contents[ident] = None
+                continue
+            chunked = data[ident]
+            digests = alldigests.get(ident, {})
+            for key, digest in digests.items():
+                if digest in blocks or digest in self.chunks:
+                    self.deduplicated += 1
+                    continue
+                blocks[digest] = chunked.blocks[key]
+            saved[ident] = digests
+            contents[ident] = (chunked.size, {**chunked.stored, **digests})
+
+        with open(self.journalpath, "r+b") as fobj:
+            # Anything after the last complete record is from a failed save
+            fobj.truncate(self.journal_end)
+            fobj.seek(self.journal_end)
+            sealed = self.parallel(self.sealblock, blocks.values())
+            for digest, encrypted in zip(blocks, sealed):
+                fobj.write(RECORD.pack(CHUNK, len(encrypted)))
+                written[digest] = StoredChunk(
+                    self.journalid, fobj.tell(), len(encrypted)
+                )
+                fobj.write(encrypted)
+
+            chunks = {digest: self.ondisk(chunk) for digest, chunk in written.items()}
+            commit = (update, contents, chunks)
+            encrypted = self.seal(pickle.dumps(commit), COMMIT)
+            fobj.write(RECORD.pack(COMMIT, len(encrypted)))
+            fobj.write(encrypted)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+            self.journal_end = fobj.tell()
+
+        with self.lock:
+            self.chunks.update(written)
+            # A block changed again after the snapshot never gets a reference
+            self.garbage.update(written)
+        return saved
+
+    def compact(self, metadata, data):
+        """
+        Writes everything into a new base file and then replaces the old one.
+        Blocks which were not changed are copied over without decrypting them,
+        and blocks without any reference are left behind. Returns the digests
+        of the dirty blocks for every id in data.
+        """
+        generation = os.urandom(GENERATION_SIZE)
+        baseid = self.nextsegment
+        self.nextsegment += 1
+        tmppath = self.path + ".tmp"
+        index = {}
+        saved = {}
+        # Every block to write, the dirty ones by their contents and the
+        # stored ones by None, in the order of the files
+        blocks = {}
+        alldigests = self.digests(data)
+        for ident, chunked in data.items():
+            digests = alldigests.get(ident, {})
+            for key, digest in digests.items():
+                if digest in blocks or digest in self.chunks:
+                    self.deduplicated += 1
+                blocks.setdefault(digest, chunked.blocks[key])
+            for digest in chunked.stored.values():
+                blocks.setdefault(digest, None)
+            saved[ident] = digests
+            index[ident] = (chunked.size, {**chunked.stored, **digests})
+        # The files which were removed while they are still open
+        with self.lock:
+            for digest in self.refs:
+                blocks.setdefault(digest, None)
+
+        chunks = {}
+        with open(tmppath, "wb") as fobj:
+            fobj.write(HEADER + self.keyheader.pack())
+            sealed = self.parallel(self.copyorseal, blocks.items())
+            for digest, encrypted in zip(blocks, sealed):
+                chunks[digest] = StoredChunk(baseid, fobj.tell(), len(encrypted))
+                fobj.write(encrypted)
+
+            ondisk = {
+                digest: (BASE, chunk.offset, chunk.length)
+                for digest, chunk in chunks.items()
+            }
+            encrypted = self.seal(
+                pickle.dumps((generation, metadata, index, ondisk)), INDEX
+            )
+            index_offset = fobj.tell()
+            fobj.write(encrypted)
+            fobj.write(TRAILER.pack(index_offset, len(encrypted), MAGIC))
+            fobj.flush()
+            os.fsync(fobj.fileno())
+
+        os.replace(tmppath, self.path)
+        fsync_directory(self.path)
+        # The journal belongs to the old generation now, so it is safe to lose it
+        if os.path.exists(self.journalpath):
+            os.remove(self.journalpath)
+        with self.lock:
+            self.retired.extend(
+                segment
+                for segment in (self.baseid, self.journalid)
+                if segment is not None
+            )
+            self.segments[baseid] = open(self.path, "rb")
+            self.chunks = chunks
+            self.garbage.update(chunks)
+            self.baseid = baseid
+            self.journalid = None
+        self.generation = generation
+        self.journal_end = 0
+        return saved
+
+    def copyorseal(self, item):
+        "Returns the encrypted block, as it is on the disk if it is stored already"
+        digest, block = item
+        if digest in self.chunks:
+            return self.read_raw(self.chunks[digest])
+        return self.sealblock(block)
+
+    def release(self):
+        """
+        Ends a hold. Once nothing holds the store, the digests which lost all
+        of their references are dropped, and the files which no block points
+        to any more are closed.
+        """
+        with self.lock:
+            self.holds -= 1
+            if self.holds:
+                return
+            for digest in self.garbage:
+                if digest not in self.refs:
+                    self.chunks.pop(digest, None)
+                    self.cache.pop(digest)
+            self.garbage.clear()
+            for segment in self.retired:
+                self.segments.pop(segment).close()
+            self.retired = []
+
+    def reset(self):
+        "Closes the files and forgets every block, as before a load"
+        for fobj in self.segments.values():
+            fobj.close()
+        self.segments = {}
+        self.retired = []
+        self.baseid = None
+        self.journalid = None
+        self.chunks = {}
+        self.refs = {}
+        self.cache.clear()
+        self.garbage = set()
+
+    def close(self):
+        "Same as reset, also stops the workers and unlocks, for good"
+        self.reset()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+        # Closing the file lets go of the lock
+        self.lockfile.close()
@@ -0,0 +1,301 @@
+import argparse
+import binascii
+import logging
+import os
+import posixpath
+import stat
+import sys
+from errno import EEXIST, ENOTDIR
+from pathlib import Path
+from time import perf_counter
+
+from cryptography.fernet import InvalidToken
+
+from .chunks import BLOCK_SIZE
+from .crypto import SCRYPT_COST
+from .fs import ManualBoxFS
+from .fuseapi import FuseOSError
+from .headless import keyerror, readkey
+from .storage import StorageInUse
+
+# Files are read and written this much at a time, a whole number of blocks
+BUFFER_SIZE = 8 * 1024 * 1024
+# The blocks get encrypted and saved once this much was imported
+SAVE_EVERY = 256 * 1024 * 1024
+
+
+class Counter:
+    "What a transfer did, for the summary at the end"
+
+    def __init__(self):
+        self.files = 0
+        self.directories = 0
+        self.symlinks = 0
+        self.skipped = 0
+        self.bytes = 0
+        self.started = perf_counter()
+
+    def summary(self):
+        seconds = perf_counter() - self.started
+        speed = self.bytes / seconds / 2**20 if seconds else 0
+        return (
+            f"{self.files} files, {self.directories} directories, "
+            f"{self.symlinks} symlinks, {self.bytes / 2**20:.1f} MiB "
+            f"in {seconds:.1f} s ({speed:.1f} MiB/s), {self.skipped} skipped"
+        )
+
+
+def importfile(fs, hostpath, path, buffer):
+    "Copies one host file into the vault, returns the number of bytes"
+    mode = stat.S_IMODE(os.stat(hostpath).st_mode)
+    # Opened first, an unreadable file does not replace the one in the vault
+    fobj = open(hostpath, "rb", buffering=0)
+    try:
+        fh = fs.create(path, mode)
+    except BaseException:
+        fobj.close()
+        raise
+    offset = 0
+    try:
+        with fobj:
+            while True:
+                count = fobj.readinto(buffer)
+                if not count:
+                    break
+                # The blocks copy what they keep, so the buffer is used again
+                fs.write(path, buffer[:count], offset, fh)
+                offset += count
+                if fs.dirtybytes >= SAVE_EVERY:
+                    fs.saveondisk()
+    except BaseException:
+        # Half a file is not kept
+        fs.release(path, fh)
+        fs.unlink(path)
+        raise
+    fs.release(path, fh)
+    return offset
+
+
+def makeparents(fs, path):
+    "Creates the missing directories above path in the vault"
+    parent = "/"
+    for name in path.strip("/").split("/")[:-1]:
+        parent = posixpath.join(parent, name)
+        try:
+            fs.mkdir(parent, 0o755)
+        except FuseOSError as err:
+            if err.errno != EEXIST:
+                raise
+
+
+def importtree(fs, source, destination):
+    """
+    Copies the host directory source to the path destination in the vault,
+    with the modes and the times. Existing files in the vault get replaced.
+    The files and directories which can not be copied are logged and skipped,
+    the rest gets imported. Returns a Counter.
+    """
+    counter = Counter()
+    buffer = memoryview(bytearray(BUFFER_SIZE))
+    # The times of a directory change with every file created inside of it
+    times = []
+    source = os.path.abspath(source)
+    if not os.path.isdir(source):
+        raise NotADirectoryError(ENOTDIR, os.strerror(ENOTDIR), source)
+    makeparents(fs, destination)
+
+    def skip(err):
+        logging.warning(f"Skipping {err.filename}: {err.strerror}")
+        counter.skipped += 1
+
+    for root, dirnames, filenames in os.walk(source, onerror=skip):
+        relative = os.path.relpath(root, source)
+        base = destination if relative == "." else posixpath.join(destination, relative)
+        try:
+            info = os.stat(root)
+            if base != "/":
+                fs.mkdir(base, stat.S_IMODE(info.st_mode))
+        except FuseOSError as err:
+            if err.errno != EEXIST or not fs.table.isdir(fs.lookup(base)):
+                skip(OSError(err.errno, err.strerror, root))
+                dirnames.clear()
+                continue
+        except OSError as err:
+            skip(err)
+            dirnames.clear()
+            continue
+        times.append((base, info))
+        counter.directories += 1
+        # Symlinks to directories are copied as symlinks, not followed
+        for name in [
+            name for name in dirnames if os.path.islink(os.path.join(root, name))
+        ]:
+            dirnames.remove(name)
+            filenames.append(name)
+        for name in filenames:
+            hostpath = os.path.join(root, name)
+            path = posixpath.join(base, name)
+            try:
+                info = os.lstat(hostpath)
+                if stat.S_ISLNK(info.st_mode):
+                    fs.symlink(path, os.readlink(hostpath))
+                    counter.symlinks += 1
+                elif stat.S_ISREG(info.st_mode):
+                    counter.bytes += importfile(fs, hostpath, path, buffer)
+                    counter.files += 1
+                    fs.utimens(path, (info.st_atime, info.st_mtime))
+                else:
+                    logging.warning(f"Skipping {hostpath}, it is not a regular file")
+                    counter.skipped += 1
+            except OSError as err:
+                skip(OSError(err.errno, err.strerror, hostpath))
+    for path, info in reversed(times):
+        fs.utimens(path, (info.st_atime, info.st_mtime))
+    return counter
+
+
+def exportfile(fs, ino, hostpath):
+    """
+    Copies the contents of the inode to a new host file, returns the number
+    of bytes. Only the blocks which are not holes get written, so a sparse
+    file stays sparse where the host filesystem can do that.
+    """
+    chunked = fs.data[ino]
+    with chunked.lock, open(hostpath, "wb") as fobj:
+        chunked.settle()
+        size = chunked.size
+        # Runs of blocks one after another, as [first, after the last]
+        runs = []
+        for index in chunked.indexes():
+            if runs and runs[-1][1] == index:
+                runs[-1][1] = index + 1
+            else:
+                runs.append([index, index + 1])
+        for first, last in runs:
+            offset = first * BLOCK_SIZE
+            end = min(last * BLOCK_SIZE, size)
+            fobj.seek(offset)
+            while offset < end:
+                # The blocks of every read get decrypted on the workers of the store
+                data = chunked.read(min(BUFFER_SIZE, end - offset), offset)
+                fobj.write(data)
+                offset += len(data)
+        fobj.truncate(size)
+    return size
+
+
+def exporttree(fs, source, destination):
+    """
+    Copies the vault directory source to the host directory destination,
+    with the modes and the times. Returns a Counter.
+    """
+    counter = Counter()
+    table = fs.table
+    ino = fs.lookup(source)
+    if not table.isdir(ino):
+        raise FuseOSError(ENOTDIR)
+    times = []
+    stack = [(ino, destination)]
+    while stack:
+        ino, hostpath = stack.pop()
+        os.makedirs(hostpath, exist_ok=True)
+        times.append((ino, hostpath))
+        counter.directories += 1
+        for name, child in table.entries[ino].items():
+            childpath = os.path.join(hostpath, name)
+            mode = table.mode[child]
+            if stat.S_ISDIR(mode):
+                stack.append((child, childpath))
+                continue
+            if stat.S_ISLNK(mode):
+                with fs.data[child].lock:
+                    target = fs.data[child].getvalue().decode("utf-8")
+                os.symlink(target, childpath)
+                counter.symlinks += 1
+                continue
+            counter.bytes += exportfile(fs, child, childpath)
+            counter.files += 1
+            os.chmod(childpath, stat.S_IMODE(mode))
+            os.utime(childpath, (table.atime[child], table.mtime[child]))
+    for ino, hostpath in reversed(times):
+        os.chmod(hostpath, stat.S_IMODE(table.mode[ino]))
+        os.utime(hostpath, (table.atime[ino], table.mtime[ino]))
+    return counter
+
+
+def main():
+    "Copies directory trees into and out of the storage, without mounting it"
+    # The options of both commands
+    options = argparse.ArgumentParser(add_help=False)
+    options.add_argument(
+        "--storage",
+        default=os.path.join(str(Path.home()), ".manualbox"),
+        help="encrypted storage file, it must not be mounted (default: ~/.manualbox)",
+    )
+    options.add_argument(
+        "--key-file", help="read the key from this file instead of $MANUALBOX_KEY"
+    )
+    options.add_argument(
+        "--passphrase-cost",
+        type=int,
+        nargs="?",
+        const=SCRYPT_COST,
+        metavar="N",
+        help="a new storage takes the key as a passphrase for scrypt with cost 2**N"
+        f" (default N: {SCRYPT_COST})",
+    )
+    options.add_argument(
+        "--workers",
+        type=int,
+        help="threads which encrypt and decrypt the blocks (default: one per CPU)",
+    )
+    parser = argparse.ArgumentParser(prog="manualbox", description=main.__doc__)
+    commands = parser.add_subparsers(dest="command", required=True)
+    importer = commands.add_parser(
+        "import", parents=[options], help="copy a host directory in"
+    )
+    importer.add_argument("source", help="directory on the host")
+    importer.add_argument(
+        "destination",
+        nargs="?",
+        help="directory in the storage (default: /name of the source)",
+    )
+    exporter = commands.add_parser(
+        "export", parents=[options], help="copy a directory out"
+    )
+    exporter.add_argument("source", help="directory in the storage, like /")
+    exporter.add_argument("destination", help="directory on the host")
+    args = parser.parse_args()
+
+    try:
+        fs = ManualBoxFS(
+            key=readkey(args),
+            storagepath=args.storage,
+            workers=args.workers,
+            passphrase_cost=args.passphrase_cost,
+        )
+    except StorageInUse as err:
+        print(f"{err}, unmount it first", file=sys.stderr)
+        return 1
+    except (ValueError, InvalidToken, binascii.Error):
+        print(keyerror(args.storage), file=sys.stderr)
+        return 1
+    try:
+        if args.command == "import":
+            source = args.source.rstrip(os.sep) or os.sep
+            destination = args.destination or "/" + os.path.basename(source)
+            try:
+                counter = importtree(fs, source, destination.rstrip("/") or "/")
+            finally:
+                # What got imported before a failure or ^C is kept
+                fs.saveondisk()
+        else:
+            counter = exporttree(fs, args.source.rstrip("/") or "/", args.destination)
+    except OSError as err:
+        # FuseOSError from the storage, or anything from the host files
+        print(f"Failed: {err}", file=sys.stderr)
+        return 1
+    finally:
+        fs.close()
+    print(counter.summary())
+    return 0
@@ -18,6 +18,8 @@ setup(
         "console_scripts": [
             "manualbox = manualbox:main",
             "manualboxinput = manualbox.manualinput:main",
+            "manualbox-approve = manualbox.broker:main",
+            "manualbox-headless = manualbox.headless:main",
         ]
     },
 )
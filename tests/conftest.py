@@ -0,0 +1,65 @@
+"""
+Fixtures to use ManualBoxFS and its storage without mounting it.
+"""
+
+import pytest
+from cryptography.fernet import Fernet
+
+from manualbox.fs import ManualBoxFS
+
+
+def writefile(fs, path, data):
+    "Replaces the contents of path, creating the file if it is not there"
+    if fs.table.lookup(path) is None:
+        fs.release(path, fs.create(path, 0o644))
+    fs.truncate(path, 0)
+    fs.write(path, data, 0, None)
+
+
+def contents(fs, path):
+    chunked = fs.data[fs.lookup(path)]
+    with chunked.lock:
+        return chunked.getvalue()
+
+
+@pytest.fixture
+def key():
+    return Fernet.generate_key()
+
+
+@pytest.fixture
+def storagepath(tmp_path):
+    return str(tmp_path / "storage")
+
+
+@pytest.fixture
+def openfs(storagepath, key):
+    """
+    Opens the storage with ManualBoxFS, the arguments go to ManualBoxFS. The
+    filesystems still open at the end of the test get closed.
+    """
+    opened = []
+
+    def openfs(**kwargs):
+        kwargs.setdefault("key", key)
+        kwargs.setdefault("storagepath", storagepath)
+        kwargs.setdefault("workers", 1)
+        fs = ManualBoxFS(**kwargs)
+        opened.append(fs)
+        return fs
+
+    yield openfs
+    for fs in opened:
+        fs.close()
+
+
+@pytest.fixture
+def reopen(openfs):
+    "Saves and closes a filesystem, as an unmount does, and loads it again"
+
+    def reopen(fs, **kwargs):
+        fs.saveondisk()
+        fs.close()
+        return openfs(**kwargs)
+
+    return reopen
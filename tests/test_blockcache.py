@@ -0,0 +1,42 @@
+import os
+
+from conftest import contents, writefile
+from manualbox.blockcache import BlockCache
+from manualbox.chunks import BLOCK_SIZE
+
+
+def test_least_recently_used_is_dropped():
+    cache = BlockCache(maxbytes=30)
+    cache.put("a", b"a" * 10)
+    cache.put("b", b"b" * 10)
+    cache.put("c", b"c" * 10)
+    assert cache.get("a") == b"a" * 10
+    cache.put("d", b"d" * 10)
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert cache.size == 30
+    # A block larger than the cache still stays, alone
+    cache.put("e", b"e" * 40)
+    assert len(cache) == 1
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"]) == (1, 1, 4)
+
+
+def test_put_keeps_the_cached_block():
+    cache = BlockCache()
+    first = b"x" * 10
+    assert cache.put("x", first) is first
+    assert cache.put("x", b"x" * 10) is first
+    cache.pop("x")
+    cache.pop("x")
+    assert cache.size == 0
+
+
+def test_reads_stay_within_the_cache_size(openfs, reopen):
+    data = os.urandom(8 * BLOCK_SIZE)
+    fs = openfs()
+    writefile(fs, "/a", data)
+    fs = reopen(fs, cache_size=2 * BLOCK_SIZE)
+    assert contents(fs, "/a") == data
+    assert fs.store.cache.size <= 2 * BLOCK_SIZE
+    assert contents(fs, "/a") == data
@@ -0,0 +1,66 @@
+import threading
+
+import pytest
+
+from manualbox.broker import NOPE, OKAY, ApprovalBroker, Client, SocketServer
+
+
+@pytest.fixture
+def server(tmp_path):
+    broker = ApprovalBroker(timeout=5)
+    server = SocketServer(broker, str(tmp_path / "sock"), token="secret")
+    server.start()
+    yield server
+    server.stop()
+
+
+def ask(broker, answers):
+    "Asks in another thread, the answer goes into answers"
+    thread = threading.Thread(
+        target=lambda: answers.append(broker.ask("/secured/file", "cat"))
+    )
+    thread.start()
+    return thread
+
+
+def test_timeout_denies():
+    broker = ApprovalBroker(timeout=0.01)
+    assert broker.ask("/secured/file", "cat") == NOPE
+    assert broker.stats()["timed_out"] == 1
+    assert broker.answer(1, OKAY) is False
+
+
+@pytest.mark.parametrize("token", [None, "wrong", "secre"])
+def test_wrong_token_sees_nothing(server, token):
+    answers = []
+    thread = ask(server.broker, answers)
+    client = Client(server.path, token)
+    if token is None:
+        # Without a token the first line is taken as the token
+        client.answer(1, OKAY)
+    try:
+        # The server hangs up without sending the question
+        assert list(client) == []
+    finally:
+        client.close()
+    assert not answers
+    assert server.broker.stats()["listeners"] == 0
+    server.broker.answer(1, NOPE)
+    thread.join()
+    assert answers == [NOPE]
+
+
+def test_right_token_answers(server):
+    answers = []
+    thread = ask(server.broker, answers)
+    client = Client(server.path, "secret")
+    try:
+        messages = iter(client)
+        question = next(messages)
+        assert question == {"id": 1, "path": "/secured/file", "process": "cat"}
+        client.answer(question["id"], OKAY)
+        assert next(messages) == {"id": 1, "answer": OKAY}
+    finally:
+        client.close()
+    thread.join()
+    assert answers == [OKAY]
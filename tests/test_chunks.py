@@ -0,0 +1,113 @@
+import os
+
+from manualbox.chunks import BLOCK_SIZE, ChunkedFile
+
+
+def test_small_writes_are_collected():
+    chunked = ChunkedFile()
+    data = os.urandom(BLOCK_SIZE + 1000)
+    offset = 0
+    while offset + 100 < BLOCK_SIZE:
+        chunked.write(data[offset : offset + 100], offset)
+        offset += 100
+    # Nothing got into the blocks yet
+    assert chunked.blocks == {}
+    assert chunked.size == offset
+    assert chunked.allocated() == offset
+    # The first block is written out once the tail reaches the second one
+    chunked.write(data[offset:], offset)
+    assert chunked.tail is None
+    assert sorted(chunked.blocks) == [0, 1]
+    assert chunked.getvalue() == data
+
+
+def test_a_read_sees_the_collected_writes():
+    chunked = ChunkedFile(b"x" * 10)
+    chunked.write(b"abc", 10)
+    chunked.write(b"def", 13)
+    version = chunked.version
+    assert chunked.read(4, 8) == b"xxab"
+    assert chunked.tail is None
+    # A write somewhere else starts a new tail
+    chunked.write(b"z", 2)
+    assert chunked.getvalue() == b"xxzxxxxxxxabcdef"
+    assert chunked.version == version + 1
+
+
+def test_holes_take_no_blocks():
+    chunked = ChunkedFile()
+    chunked.truncate(10 * BLOCK_SIZE)
+    assert chunked.blocks == {}
+    assert chunked.allocated() == 0
+    chunked.write(b"end", 20 * BLOCK_SIZE)
+    chunked.settle()
+    assert chunked.indexes() == [20]
+    assert chunked.allocated() == BLOCK_SIZE
+    assert chunked.read(10, 5 * BLOCK_SIZE) == bytes(10)
+    assert chunked.read(5, 20 * BLOCK_SIZE - 2) == b"\0\0end"
+    assert len(chunked) == 20 * BLOCK_SIZE + 3
+
+
+def test_zero_blocks_become_holes():
+    chunked = ChunkedFile(os.urandom(3 * BLOCK_SIZE))
+    chunked.write(bytes(BLOCK_SIZE), BLOCK_SIZE)
+    assert chunked.indexes() == [0, 2]
+    # Cutting a block with only zero bytes left also drops it
+    chunked.write(bytes(100), 2 * BLOCK_SIZE)
+    chunked.truncate(2 * BLOCK_SIZE + 100)
+    assert chunked.indexes() == [0]
+    assert chunked.read(100, 2 * BLOCK_SIZE) == bytes(100)
+    # Extending reads back zero bytes, not what was cut off
+    chunked.truncate(3 * BLOCK_SIZE)
+    assert chunked.read(BLOCK_SIZE, 2 * BLOCK_SIZE) == bytes(BLOCK_SIZE)
+
+
+class Store:
+    "Keeps the blocks handed over by ChunkedFile.saved"
+
+    def __init__(self):
+        self.blocks = {}
+
+    def ref(self, digest, block):
+        self.blocks[digest] = bytes(block)
+
+    def unref(self, digest):
+        pass
+
+    def block(self, digest):
+        return self.blocks[digest]
+
+
+def test_partial_writes_change_the_block_in_place():
+    chunked = ChunkedFile(b"a" * 100)
+    chunked.settle()
+    block = chunked.blocks[0]
+    chunked.write(b"b", 10)
+    chunked.settle()
+    assert chunked.blocks[0] is block
+    assert chunked.read(3, 9) == b"aba"
+
+
+def test_snapshot_blocks_are_copied_on_write():
+    chunked = ChunkedFile(b"a" * 100)
+    chunked.write(b"c" * 100, 2 * BLOCK_SIZE)
+    chunked.settle()
+    snapshot = chunked.snapshot()
+    first, last = chunked.blocks[0], chunked.blocks[2]
+    chunked.write(b"b", 10)
+    chunked.settle()
+    assert chunked.blocks[0] is not first
+    assert snapshot.blocks[0] is first
+    assert snapshot.read(3, 9) == b"aaa"
+    assert chunked.read(3, 9) == b"aba"
+    # The snapshot got saved, only the block written meanwhile stays dirty
+    store = Store()
+    chunked.saved(snapshot, {0: "first", 2: "last"}, store)
+    assert chunked.dirty == {0}
+    assert chunked.stored == {2: "last"}
+    assert store.blocks["last"] == bytes(last)
+    assert chunked.read(3, 2 * BLOCK_SIZE) == b"ccc"
+    # Nothing is frozen any more
+    chunked.write(b"d", 11)
+    chunked.settle()
+    assert chunked.read(3, 9) == b"abd"
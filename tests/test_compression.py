@@ -0,0 +1,48 @@
+import os
+
+import pytest
+
+from conftest import contents, writefile
+from manualbox.compression import NONE, SAMPLE_SIZE, Compressor, codec
+
+
+def test_only_what_gets_smaller_is_compressed():
+    compressor = Compressor("zlib")
+    text = b"manualbox " * 1000
+    noise = os.urandom(len(text))
+    packed = compressor.pack(text)
+    assert packed[0] == codec("zlib").id
+    assert len(packed) < len(text) // 10
+    assert compressor.pack(noise) == bytes((NONE.id,)) + noise
+    # A compressible tail does not help when the sample does not compress
+    mixed = os.urandom(SAMPLE_SIZE) + text
+    assert compressor.pack(mixed)[0] == NONE.id
+    assert compressor.unpack(packed) == text
+    stats = compressor.stats()
+    assert (stats["compressed"], stats["skipped"]) == (1, 2)
+    assert stats["bytes_in"] == len(text) + len(noise) + len(mixed)
+
+
+def test_segments_are_read_with_their_own_codec():
+    text = b"manualbox " * 1000
+    stored = Compressor("zlib").pack(text)
+    assert Compressor(None).unpack(stored) == text
+    uncompressed = Compressor(None).pack(text)
+    assert uncompressed[0] == NONE.id
+    assert Compressor("zlib").unpack(uncompressed) == text
+    with pytest.raises(ValueError):
+        Compressor("zlib").unpack(b"\xff" + text)
+    with pytest.raises(ValueError):
+        Compressor("nothing")
+
+
+def test_storage_written_with_another_codec(openfs, reopen):
+    text = b"manualbox " * 10000
+    fs = openfs(compression=None)
+    writefile(fs, "/a", text)
+    fs = reopen(fs, compression="zlib")
+    assert contents(fs, "/a") == text
+    writefile(fs, "/b", text[::-1])
+    fs = reopen(fs, compression=None)
+    assert contents(fs, "/a") == text
+    assert contents(fs, "/b") == text[::-1]
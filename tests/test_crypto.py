@@ -0,0 +1,56 @@
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+
+from conftest import contents, writefile
+from manualbox.crypto import RAW, SCRYPT, KeyHeader, SegmentCipher
+
+
+def test_key_header_round_trip(key):
+    header, secret = KeyHeader.new(key)
+    again = KeyHeader.unpack(header.pack())
+    assert again.kdf == RAW
+    assert again.unlock(key) == secret
+    with pytest.raises(InvalidToken):
+        again.unlock(Fernet.generate_key())
+    with pytest.raises(ValueError):
+        again.unlock(b"not a key")
+
+
+def test_passphrase_header():
+    header, secret = KeyHeader.new(b"correct horse", cost=10)
+    again = KeyHeader.unpack(header.pack())
+    assert (again.kdf, again.cost) == (SCRYPT, 10)
+    assert again.unlock(b"correct horse") == secret
+    with pytest.raises(InvalidToken):
+        again.unlock(b"battery staple")
+    # The salt makes every storage different
+    assert KeyHeader.new(b"correct horse", cost=10)[1] != secret
+
+
+def test_segments_are_bound_to_their_kind(key):
+    header, secret = KeyHeader.new(key)
+    cipher = SegmentCipher(secret, header.pack())
+    token = cipher.encrypt(b"block", 1)
+    assert cipher.decrypt(token, 1) == b"block"
+    with pytest.raises(InvalidToken):
+        cipher.decrypt(token, 2)
+    with pytest.raises(InvalidToken):
+        cipher.decrypt(token[:-1] + bytes((token[-1] ^ 1,)), 1)
+    other, othersecret = KeyHeader.new(Fernet.generate_key())
+    with pytest.raises(InvalidToken):
+        SegmentCipher(othersecret, header.pack()).decrypt(token, 1)
+
+
+@pytest.mark.parametrize("passphrase", [False, True])
+def test_wrong_key(openfs, key, passphrase):
+    if passphrase:
+        key = b"correct horse"
+    fs = openfs(key=key, passphrase_cost=10 if passphrase else None)
+    writefile(fs, "/a", b"secret")
+    fs.saveondisk()
+    fs.close()
+    wrong = b"battery staple" if passphrase else Fernet.generate_key()
+    with pytest.raises(InvalidToken):
+        openfs(key=wrong)
+    fs = openfs(key=key)
+    assert contents(fs, "/a") == b"secret"
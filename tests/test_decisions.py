@@ -0,0 +1,97 @@
+import weakref
+
+import pytest
+
+from manualbox import decisions
+from manualbox.decisions import DecisionCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    "The time of the cache, set now[0] to move it"
+    now = [1000.0]
+    monkeypatch.setattr(decisions, "monotonic", lambda: now[0])
+    return now
+
+
+class Listener:
+    def __init__(self):
+        self.expired = []
+
+    def onexpire(self, keys):
+        self.expired.extend(keys)
+
+
+def listen(cache):
+    listener = Listener()
+    cache.onexpire = weakref.WeakMethod(listener.onexpire)
+    return listener
+
+
+def test_answers_expire(clock):
+    cache = DecisionCache(ttl=30)
+    listener = listen(cache)
+    cache.put("allowed", True)
+    cache.put("denied", False)
+    clock[0] += 20
+    assert cache.get("allowed") is True
+    assert cache.get("denied") is False
+    clock[0] += 20
+    cache.sweep()
+    # A use keeps an allowed answer, a denied one lasts from the answer
+    assert cache.get("allowed") is True
+    assert cache.get("denied") is None
+    clock[0] += 31
+    cache.sweep()
+    assert len(cache) == 0
+    assert listener.expired == ["allowed"]
+
+
+def test_peek_is_not_a_use(clock):
+    cache = DecisionCache(ttl=30)
+    cache.put("key", True)
+    clock[0] += 20
+    assert cache.peek("key") is True
+    clock[0] += 20
+    cache.sweep()
+    assert cache.peek("key") is None
+    assert cache.stats() == {"entries": 0, "hits": 0, "misses": 0}
+
+
+def test_least_recently_used_is_dropped(clock):
+    cache = DecisionCache(maxsize=2)
+    listener = listen(cache)
+    cache.put("a", True)
+    cache.put("b", False)
+    cache.get("a")
+    cache.put("c", True)
+    assert cache.peek("b") is None
+    cache.put("d", True)
+    assert cache.peek("a") is None
+    assert len(cache) == 2
+    # Dropped allowed keys are passed on by the next sweep
+    assert listener.expired == []
+    cache.sweep()
+    assert listener.expired == ["a"]
+
+
+def test_sweep_without_a_listener(clock):
+    cache = DecisionCache(ttl=1)
+    listener = listen(cache)
+    del listener
+    cache.put("key", True)
+    clock[0] += 2
+    cache.sweep()
+    assert len(cache) == 0
+
+
+def test_timer_stops(clock):
+    cache = DecisionCache(sweep_interval=0.01)
+    cache.start()
+    sweeper = cache.sweeper
+    cache.stop()
+    sweeper.join(1)
+    assert not sweeper.is_alive()
+    cache.start()
+    assert cache.sweeper is not sweeper
+    cache.stop()
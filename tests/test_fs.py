@@ -0,0 +1,91 @@
+from errno import EINVAL, EIO, EISDIR, ENOENT, ENOTDIR, ENOTEMPTY
+
+import pytest
+
+from conftest import contents, writefile
+from manualbox.chunks import ChunkedFile
+from manualbox.fuseapi import FuseOSError
+
+
+def fails(errno, call, *args):
+    with pytest.raises(FuseOSError) as error:
+        call(*args)
+    assert error.value.errno == errno
+
+
+def test_rename_moves_the_whole_directory(openfs, reopen):
+    fs = openfs()
+    fs.mkdir("/a", 0o755)
+    fs.mkdir("/a/b", 0o755)
+    writefile(fs, "/a/b/file", b"inside")
+    fs.mkdir("/c", 0o755)
+    ino = fs.lookup("/a/b/file")
+    fs.rename("/a", "/c/d")
+    assert fs.lookup("/c/d/b/file") == ino
+    assert fs.table.lookup("/a") is None
+    assert fs.getattr("/")["st_nlink"] == 3
+    assert fs.getattr("/c")["st_nlink"] == 3
+    fs = reopen(fs)
+    assert contents(fs, "/c/d/b/file") == b"inside"
+    assert fs.readdir("/c/d", None) == [".", "..", "b"]
+
+
+def test_rename_over_an_existing_name(openfs):
+    fs = openfs()
+    fs.mkdir("/dir", 0o755)
+    fs.mkdir("/empty", 0o755)
+    fs.mkdir("/full", 0o755)
+    writefile(fs, "/full/file", b"")
+    writefile(fs, "/a", b"a")
+    writefile(fs, "/b", b"b")
+    fails(EINVAL, fs.rename, "/dir", "/dir/inside")
+    fails(EISDIR, fs.rename, "/a", "/dir")
+    fails(ENOTDIR, fs.rename, "/dir", "/a")
+    fails(ENOTEMPTY, fs.rename, "/dir", "/full")
+    fails(ENOENT, fs.rename, "/missing", "/c")
+    fs.rename("/a", "/b")
+    assert contents(fs, "/b") == b"a"
+    fs.rename("/dir", "/empty")
+    assert fs.readdir("/", None) == [".", "..", "full", "b", "empty"]
+    assert fs.getattr("/")["st_nlink"] == 4
+
+
+def test_rmdir(openfs):
+    fs = openfs()
+    fs.mkdir("/dir", 0o755)
+    writefile(fs, "/dir/file", b"")
+    fails(ENOTEMPTY, fs.rmdir, "/dir")
+    fails(ENOTDIR, fs.rmdir, "/dir/file")
+    fails(ENOENT, fs.rmdir, "/missing")
+    fs.unlink("/dir/file")
+    fs.rmdir("/dir")
+    assert fs.readdir("/", None) == [".", ".."]
+    assert fs.getattr("/")["st_nlink"] == 2
+
+
+def test_directories_have_no_contents(openfs):
+    fs = openfs()
+    fs.mkdir("/dir", 0o755)
+    writefile(fs, "/file", b"")
+    fails(ENOTDIR, fs.readdir, "/file", None)
+    fails(EISDIR, fs.open, "/dir", 0)
+    fails(EISDIR, fs.truncate, "/dir", 0)
+    fails(EINVAL, fs.readlink, "/dir")
+    fails(ENOTDIR, fs.create, "/file/name", 0o644)
+    assert fs.lookup("/dir") not in fs.data
+
+
+def test_failed_write_is_an_error(openfs, monkeypatch):
+    fs = openfs()
+    fh = fs.create("/file", 0o644)
+    fs.write("/file", b"before", 0, fh)
+    dirty = fs.dirtybytes
+
+    def failing(self, data, offset):
+        raise MemoryError
+
+    monkeypatch.setattr(ChunkedFile, "write", failing)
+    fails(EIO, fs.write, "/file", b"after", 0, fh)
+    assert fs.dirtybytes == dirty
+    monkeypatch.undo()
+    assert contents(fs, "/file") == b"before"
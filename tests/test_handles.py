@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from manualbox.chunks import ChunkedFile
+from manualbox.handles import READAHEAD_SIZE, HandleTable
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    "The (size, offset) of every read of the contents"
+    calls = []
+    read = ChunkedFile.read
+
+    def counted(self, size, offset):
+        calls.append((size, offset))
+        return read(self, size, offset)
+
+    monkeypatch.setattr(ChunkedFile, "read", counted)
+    return calls
+
+
+def test_numbers_are_used_again():
+    table = HandleTable()
+    chunked = ChunkedFile()
+    first, second, third = [table.open(ino, chunked) for ino in (1, 2, 3)]
+    assert (first, second, third) == (1, 2, 3)
+    table.release(second)
+    table.release(first)
+    assert table.open(4, chunked) == 1
+    assert table.open(5, chunked) == 2
+    assert table.open(6, chunked) == 4
+    assert table.get(1).ino == 4
+    assert table.release(99) is None
+    assert table.stats() == {"open": 4, "opened": 6}
+
+
+def test_contents_stay_in_use_till_the_last_release():
+    table = HandleTable()
+    chunked = ChunkedFile()
+    first = table.open(1, chunked)
+    second = table.open(1, chunked)
+    table.release(first)
+    assert table.isopen(chunked)
+    table.release(second)
+    assert not table.isopen(chunked)
+
+
+def test_sequential_reads_use_the_readahead(reads):
+    data = os.urandom(3 * READAHEAD_SIZE)
+    table = HandleTable()
+    handle = table.get(table.open(1, ChunkedFile(data)))
+    size = 4096
+    for offset in range(0, READAHEAD_SIZE, size):
+        assert handle.read(size, offset) == data[offset : offset + size]
+    assert reads == [(READAHEAD_SIZE, 0)]
+    assert handle.read(size, READAHEAD_SIZE) == data[READAHEAD_SIZE:][:size]
+    assert len(reads) == 2
+
+
+def test_random_reads_do_not_read_ahead(reads):
+    data = os.urandom(3 * READAHEAD_SIZE)
+    table = HandleTable()
+    handle = table.get(table.open(1, ChunkedFile(data)))
+    assert handle.read(100, 5000) == data[5000:5100]
+    assert handle.read(100, 200000) == data[200000:200100]
+    assert reads == [(100, 5000), (100, 200000)]
+
+
+def test_a_write_makes_the_readahead_stale():
+    chunked = ChunkedFile(b"a" * 10000)
+    table = HandleTable()
+    handle = table.get(table.open(1, chunked))
+    assert handle.read(10, 0) == b"a" * 10
+    with chunked.lock:
+        chunked.write(b"b" * 10, 10)
+    assert handle.read(10, 10) == b"b" * 10
+    # At the end of the file a short readahead is still a hit
+    assert handle.read(100, 9990) == b"a" * 10
@@ -0,0 +1,50 @@
+import json
+from errno import ENOENT, EROFS
+
+import pytest
+
+from manualbox.fuseapi import FuseOSError
+from manualbox.stats import STATS_DIR, STATS_PATH
+
+
+def readstats(fs):
+    size = fs("getattr", STATS_PATH)["st_size"]
+    fs("open", STATS_PATH, 0)
+    return json.loads(fs("read", STATS_PATH, size + 100, 0, 0))
+
+
+def test_operations_are_counted(openfs):
+    fs = openfs()
+    fh = fs("create", "/a", 0o644)
+    fs("write", "/a", b"hello", 0, fh)
+    fs("release", "/a", fh)
+    with pytest.raises(FuseOSError):
+        fs("getattr", "/missing")
+    operations = readstats(fs)["operations"]
+    assert operations["write"]["calls"] == 1
+    assert operations["write"]["bytes"] == 5
+    assert operations["getattr"]["errors"] == 1
+    assert sum(operations["create"]["latency"].values()) == 1
+    # The stats file is not measured itself
+    assert "open" not in operations
+    assert "decisions" in readstats(fs)
+
+
+def test_stats_file_is_read_only(openfs):
+    fs = openfs()
+    assert fs("readdir", STATS_DIR, 0) == [".", "..", "stats"]
+    assert fs("getattr", STATS_DIR)["st_nlink"] == 2
+    for op, args in [
+        ("write", (STATS_PATH, b"x", 0, 0)),
+        ("unlink", (STATS_PATH,)),
+        ("mkdir", (STATS_DIR + "/dir", 0o755)),
+        ("rename", (STATS_PATH, "/stats")),
+    ]:
+        with pytest.raises(FuseOSError) as error:
+            fs(op, *args)
+        assert error.value.errno == EROFS
+    with pytest.raises(FuseOSError) as error:
+        fs("getattr", STATS_DIR + "/missing")
+    assert error.value.errno == ENOENT
+    # Nothing of it ends up in the storage
+    assert fs.table.lookup(STATS_DIR) is None
@@ -0,0 +1,167 @@
+"""
+The storage file and its journal, saved and loaded through ManualBoxFS
+without mounting it.
+"""
+
+import os
+import pickle
+from collections import Counter, defaultdict
+
+import pytest
+from cryptography.fernet import Fernet
+
+from conftest import contents, writefile
+from manualbox import storage
+from manualbox.chunks import BLOCK_SIZE
+
+
+def references(fs):
+    "How many times every digest is used by the files"
+    return Counter(
+        digest for chunked in fs.data.values() for digest in chunked.stored.values()
+    )
+
+
+def test_journal_replay(storagepath, openfs, reopen):
+    fs = openfs()
+    writefile(fs, "/a", b"first")
+    fs.mkdir("/dir", 0o755)
+    fs = reopen(fs)
+    # Only the changes go into the journal now
+    data = os.urandom(3 * BLOCK_SIZE + 100)
+    writefile(fs, "/dir/b", data)
+    fs.rename("/a", "/dir/a")
+    fs = reopen(fs)
+    assert os.path.getsize(storagepath + ".journal") > 0
+    assert contents(fs, "/dir/a") == b"first"
+    assert contents(fs, "/dir/b") == data
+    assert fs.getattr("/dir/b")["st_size"] == len(data)
+    assert fs.table.lookup("/a") is None
+
+
+def test_torn_journal_record(storagepath, openfs, reopen):
+    fs = openfs()
+    writefile(fs, "/a", b"one")
+    fs = reopen(fs)
+    writefile(fs, "/a", b"two")
+    fs.saveondisk()
+    complete = os.path.getsize(storagepath + ".journal")
+    writefile(fs, "/a", b"three" * BLOCK_SIZE)
+    fs.saveondisk()
+    fs.close()
+    # A crash in the middle of the last save
+    with open(storagepath + ".journal", "r+b") as fobj:
+        fobj.truncate(os.path.getsize(storagepath + ".journal") - 10)
+    fs = openfs()
+    assert contents(fs, "/a") == b"two"
+    assert fs.store.journal_end == complete
+    # The next save writes over the torn record
+    writefile(fs, "/a", b"four")
+    fs = reopen(fs)
+    assert contents(fs, "/a") == b"four"
+
+
+def test_journal_of_an_older_generation(storagepath, openfs, reopen, monkeypatch):
+    fs = openfs()
+    writefile(fs, "/a", b"one")
+    fs = reopen(fs)
+    writefile(fs, "/a", b"two")
+    fs.saveondisk()
+    with open(storagepath + ".journal", "rb") as fobj:
+        stale = fobj.read()
+    # Every save compacts now
+    monkeypatch.setattr(storage, "COMPACT_MIN_SIZE", 0)
+    monkeypatch.setattr(storage, "COMPACT_RATIO", 0)
+    writefile(fs, "/a", b"three")
+    fs = reopen(fs)
+    assert not os.path.exists(storagepath + ".journal")
+    fs.close()
+    monkeypatch.undo()
+    # A crash right after the new base file replaced the old one
+    with open(storagepath + ".journal", "wb") as fobj:
+        fobj.write(stale)
+    fs = openfs()
+    assert contents(fs, "/a") == b"three"
+
+
+def test_only_the_changed_files_are_saved(openfs, reopen):
+    fs = openfs()
+    writefile(fs, "/a", os.urandom(4 * BLOCK_SIZE))
+    writefile(fs, "/b", b"b")
+    fs = reopen(fs)
+    writefile(fs, "/b", b"c")
+    fs.saveondisk()
+    # The blocks of /a are not written again
+    written = fs.store.journal_end
+    assert written < BLOCK_SIZE
+    # Nothing changed, nothing gets written
+    fs.saveondisk()
+    assert fs.store.journal_end == written
+
+
+def test_older_format_is_converted(storagepath, key, openfs, reopen):
+    files = {
+        "/": dict(st_mode=0o40755, st_nlink=2),
+        "/a": dict(st_mode=0o100644, st_nlink=1, st_size=5),
+        "/l": dict(st_mode=0o120777, st_nlink=1, st_size=2),
+    }
+    data = defaultdict(bytes)
+    data["/a"] = b"hello"
+    data["/l"] = "/a"
+    with open(storagepath, "wb") as fobj:
+        fobj.write(Fernet(key).encrypt(pickle.dumps((files, data))))
+    fs = openfs()
+    assert contents(fs, "/a") == b"hello"
+    assert fs.readlink("/l") == "/a"
+    fs = reopen(fs)
+    with open(storagepath, "rb") as fobj:
+        assert fobj.read(len(storage.HEADER)) == storage.HEADER
+    assert contents(fs, "/a") == b"hello"
+    assert fs.readlink("/l") == "/a"
+
+
+def test_blocks_are_decrypted_when_read(openfs, reopen):
+    fs = openfs()
+    writefile(fs, "/a", os.urandom(3 * BLOCK_SIZE))
+    writefile(fs, "/b", b"b")
+    fs = reopen(fs)
+    assert contents(fs, "/b") == b"b"
+    # Only the block of /b was read, the ones of /a are still encrypted
+    assert len(fs.store.cache) == 1
+
+
+def test_reference_counts(openfs, reopen, monkeypatch):
+    block = os.urandom(BLOCK_SIZE)
+    fs = openfs()
+    writefile(fs, "/a", block * 3)
+    writefile(fs, "/b", block + os.urandom(BLOCK_SIZE))
+    fs = reopen(fs)
+    # The same block is stored once
+    assert len(fs.store.chunks) == 2
+    assert fs.store.refs == references(fs)
+    assert fs.store.refs[fs.data[fs.lookup("/a")].stored[0]] == 4
+
+    fs.unlink("/a")
+    fs.truncate("/b", BLOCK_SIZE)
+    fs.saveondisk()
+    assert fs.store.refs == references(fs)
+    assert len(fs.store.refs) == 1
+    fs = reopen(fs)
+    assert fs.store.refs == references(fs)
+
+    # The compaction leaves the blocks without references behind
+    monkeypatch.setattr(storage, "COMPACT_MIN_SIZE", 0)
+    monkeypatch.setattr(storage, "COMPACT_RATIO", 0)
+    writefile(fs, "/c", block)
+    fs = reopen(fs)
+    assert set(fs.store.chunks) == set(fs.store.refs) == set(references(fs))
+    assert contents(fs, "/b") == block
+    assert contents(fs, "/c") == block
+
+
+def test_storage_in_use(openfs):
+    fs = openfs()
+    with pytest.raises(storage.StorageInUse):
+        openfs()
+    fs.close()
+    openfs()
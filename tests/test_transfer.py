@@ -0,0 +1,66 @@
+import os
+
+import pytest
+
+from conftest import contents
+from manualbox import transfer
+from manualbox.chunks import BLOCK_SIZE
+
+
+@pytest.fixture
+def tree(tmp_path):
+    "A host directory with a file, a sparse file, a symlink and a subdirectory"
+    source = tmp_path / "source"
+    (source / "sub").mkdir(parents=True)
+    (source / "file").write_bytes(b"hello")
+    with open(source / "sub" / "sparse", "wb") as fobj:
+        fobj.truncate(10 * BLOCK_SIZE)
+        fobj.write(b"start")
+    os.symlink("sub/sparse", source / "link")
+    os.chmod(source / "file", 0o600)
+    os.utime(source / "file", (1000, 2000))
+    return source
+
+
+def test_import_and_export(tree, tmp_path, openfs, reopen):
+    fs = openfs()
+    counter = transfer.importtree(fs, str(tree), "/a/b/copy")
+    assert (counter.files, counter.directories, counter.symlinks) == (2, 2, 1)
+    assert counter.skipped == 0
+    fs = reopen(fs)
+    assert contents(fs, "/a/b/copy/file") == b"hello"
+    assert fs.getattr("/a/b/copy/file")["st_mode"] & 0o777 == 0o600
+    assert fs.getattr("/a/b/copy/file")["st_mtime"] == 2000
+    assert fs.readlink("/a/b/copy/link") == "sub/sparse"
+    sparse = fs.data[fs.lookup("/a/b/copy/sub/sparse")]
+    assert sparse.indexes() == [0]
+
+    restored = tmp_path / "restored"
+    counter = transfer.exporttree(fs, "/a/b/copy", str(restored))
+    assert (counter.files, counter.directories, counter.symlinks) == (2, 2, 1)
+    assert (restored / "file").read_bytes() == b"hello"
+    assert os.stat(restored / "file").st_mtime == 2000
+    assert os.readlink(restored / "link") == "sub/sparse"
+    sparse = restored / "sub" / "sparse"
+    assert sparse.read_bytes() == (tree / "sub" / "sparse").read_bytes()
+    assert os.stat(sparse).st_blocks * 512 < 10 * BLOCK_SIZE
+
+
+def test_unreadable_files_are_skipped(tree, openfs, monkeypatch):
+    fs = openfs()
+    transfer.importtree(fs, str(tree), "/copy")
+    opened = open
+
+    def unreadable(path, *args, **kwargs):
+        if os.path.basename(path) == "file":
+            raise PermissionError(13, "Permission denied", path)
+        return opened(path, *args, **kwargs)
+
+    monkeypatch.setattr(transfer, "open", unreadable, raising=False)
+    (tree / "new").write_bytes(b"new")
+    counter = transfer.importtree(fs, str(tree), "/copy")
+    assert counter.skipped == 1
+    assert counter.files == 2
+    # The copy in the vault is kept
+    assert contents(fs, "/copy/file") == b"hello"
+    assert contents(fs, "/copy/new") == b"new"